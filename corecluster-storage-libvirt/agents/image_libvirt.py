@@ -27,21 +27,27 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
-import base64
+import hashlib
 import libvirt
 import urllib
-from corecluster.agents.base_agent import BaseAgent
-from corecluster.models.core import Device
+from corecluster.models.core import Device, Image
 from corecluster.exceptions.agent import *
 from corecluster.cache.data_chunk import DataChunk
 from corenetwork.utils import system
 from corenetwork.utils.logger import log
+from ..utils.connection_pool import pool
+from ..utils.pool_cache import storages
+from ..utils import transfer, ranged_download, compression, checksums, provisioning, data_chunks, local_import, reaper, copy_jobs
+from ..utils.admission import Admission
+from ..utils.progress import ProgressReporter, watch
+from ..utils.workers import PooledAgent
 
 
-class AgentThread(BaseAgent):
+class AgentThread(PooledAgent):
     task_type = 'image'
-    supported_actions = ['create', 'upload_url', 'upload_data', 'delete', 'attach', 'detach']
-    lock_on_fail = ['create', 'upload_url', 'upload_data', 'delete', 'duplicate']
+    supported_actions = ['create', 'upload_url', 'upload_data', 'finalize_upload', 'duplicate', 'delete', 'attach', 'detach']
+    long_actions = ['upload_url', 'upload_data', 'finalize_upload', 'duplicate']
+    lock_on_fail = ['create', 'upload_url', 'upload_data', 'finalize_upload', 'delete', 'duplicate']
 
     def task_failed(self, task, exception):
         if task.action in self.lock_on_fail:
@@ -57,40 +63,176 @@ class AgentThread(BaseAgent):
             raise TaskError('storage_unavailable')
 
         try:
-            storage = conn.storagePoolLookupByName(image.storage.name)
+            storage = storages.get(conn, image.storage.name)
         except Exception as e:
             image.storage.set_state('locked')
             image.storage.save()
             raise TaskFatalError('libvirt_storage_not_found', exception=e)
 
-        if storage.info()[0] != libvirt.VIR_STORAGE_POOL_RUNNING:
+        if not storage.running:
             image.storage.set_state('locked')
             image.storage.save()
             raise TaskError('libvrit_storage_not_running')
 
-        storage.refresh(0)
+        storage.refresh_if_stale()
         return storage
 
 
+    def find_duplicate(self, task, image):
+        """
+        Find image with the same content as given in task's sha256 property
+        """
+        digest = task.get_prop('sha256')
+        if digest is None:
+            return None
+
+        source = checksums.find(image.storage, digest, image.user_id, exclude=image.id)
+        if source is None or source.format != image.format:
+            return None
+        return source
+
+
+    def clone_duplicate(self, task, storage, source, image):
+        """
+        Create image's volume as clone of source image's volume (by reflink if it is possible)
+        """
+        log(msg='Image %s has the same content as %s. Cloning' % (image.id, source.id), tags=('agent', 'image', 'info'), context=task.logger_ctx)
+        try:
+            base_volume = storage.storageVolLookupByName(source.libvirt_name)
+            return provisioning.clone(storage, base_volume, image.libvirt_name, 'reflink')
+        except Exception as e:
+            raise TaskError('cannot_clone_image', exception=e)
+
+
     def create(self, task):
         image = task.get_obj('Image')
-        conn = libvirt.open('qemu:///system')
-        storage = self.get_storage(image, conn)
+        with pool.local() as conn:
+            storage = self.get_storage(image, conn)
+
+            source = self.find_duplicate(task, image)
+            if source is not None:
+                volume = self.clone_duplicate(task, storage, source, image)
+                checksums.register(image, task.get_prop('sha256'))
+            else:
+                volume_xml = image.libvirt_xml()
+
+                try:
+                    volume = storage.createXML(volume_xml, 0)
+                except Exception as e:
+                    raise TaskError('cannot_create_image', exception=e)
+
+            image.size = volume.info()[1]
+            image.set_state('ok')
+            image.save()
 
-        volume_xml = image.libvirt_xml()
+
+    def duplicate(self, task):
+        '''
+        Create image as copy of other image. Operation.data should contain:
+        - source_image - id of copied image
+        - provisioning (optional) - reflink (default, copy-on-write clone if storage supports it, full copy otherwise),
+          copy or overlay (qcow2 image backed by copied image, only in the same storage)
+        '''
+        image = task.get_obj('Image')
 
         try:
-            volume = storage.createXML(volume_xml, 0)
+            source = Image.objects.get(pk=task.get_prop('source_image'))
+        except Image.DoesNotExist as e:
+            raise TaskFatalError('image_not_found', exception=e)
+
+        if not source.in_state('ok'):
+            raise TaskNotReady('image_wrong_state')
+
+        mode = task.get_prop('provisioning', 'reflink')
+        if mode not in provisioning.MODES:
+            raise TaskFatalError('image_duplicate_mode')
+        if mode == 'overlay' and (source.format != 'qcow2' or source.storage_id != image.storage_id):
+            log(msg='Cannot create overlay over image %s. Cloning' % source.id, tags=('agent', 'image', 'info'), context=task.logger_ctx)
+            mode = 'reflink'
+
+        with pool.local() as conn:
+            src_storage = self.get_storage(source, conn)
+            storage = self.get_storage(image, conn)
+
+            try:
+                base_volume = src_storage.storageVolLookupByName(source.libvirt_name)
+            except Exception as e:
+                raise TaskFatalError('libvirt_image_not_found', exception=e)
+
+            if mode == 'overlay':
+                # Delete of source image checks for overlays only if it is marked
+                source.set_prop('overlays', True)
+                source.save()
+
+            progress = ProgressReporter(image, base_volume.info()[2])
+            try:
+                with Admission(task, storage=image.storage):
+                    with watch(progress, lambda: storage.handle.storageVolLookupByName(image.libvirt_name).info()[2]):
+                        volume = provisioning.clone(storage, base_volume, image.libvirt_name, mode, source.format)
+            except libvirt.libvirtError as e:
+                raise TaskError('image_duplicate_failed', exception=e)
+            progress.finish(progress.total)
+
+            image = task.get_obj('Image')
+            image.size = volume.info()[1]
+            if mode == 'overlay':
+                image.format = 'qcow2'
+            else:
+                image.format = source.format
+                image.set_prop('sha256', source.get_prop('sha256'))
+            image.set_state('ok')
+            image.save()
+
+        log(msg='Image %s duplicated as %s' % (source.id, image.id), tags=('agent', 'image', 'info'), context=task.logger_ctx)
+
+
+    def rebase(self, task, image, volume):
+        """
+        Remove backing file from uploaded qcow2 and qed images. Returns False if qemu-img failed
+        """
+        log(msg="Rebasing image to no backend", tags=('agent', 'image', 'info'), context=task.logger_ctx)
+        if image.format in ['qcow2', 'qed']:
+            r = system.call(['sudo',
+                             'qemu-img', 'rebase',
+                             '-u',
+                             '-f', image.format,
+                             '-u',
+                             '-b', '',
+                             volume.path()], stderr=None, stdout=None)
+            return r == 0
+        return True
+
+
+    def download(self, conn, volume, url, size, progress, sparse, sha, slot):
+        """
+        Download url sequentially by one connection. Compressed images are decompressed on the fly and read to the end,
+        then size and progress are related to decompressed data.
+        """
+        try:
+            remote = urllib.urlopen(url)
         except Exception as e:
-            raise TaskError('cannot_create_image', exception=e)
+            raise TaskError('url_not_found', exception=e)
 
-        storage.refresh(0)
+        try:
+            source, kind = compression.open_source(remote)
+        except:
+            remote.close()
+            raise
 
-        image.size = volume.info()[1]
-        image.set_state('ok')
-        image.save()
+        if kind is not None:
+            log(msg='Decompressing %s image from %s' % (kind, url), tags=('agent', 'image', 'info'))
+            size = None
+            progress.total = volume.info()[1]
 
-        conn.close()
+        reader = transfer.ReadAhead(source, size)
+        try:
+            return transfer.upload(conn, volume, slot.throttle(checksums.hashed(reader, sha)),
+                                   length=size or 0,
+                                   progress=progress.update,
+                                   sparse=sparse)
+        finally:
+            remote.close()
+            reader.close()
 
 
     def upload_url(self, task):
@@ -100,6 +242,8 @@ class AgentThread(BaseAgent):
         - action
         - url
         - size
+        - sha256 (optional) - expected SHA-256 of image's (decompressed) content. If image with the same content exists
+          in the storage, it is cloned instead of downloading
         '''
         image = task.get_obj('Image')
         if image.attached_to != None:
@@ -108,65 +252,138 @@ class AgentThread(BaseAgent):
         image.set_state('downloading')
         image.save()
 
-        conn = libvirt.open('qemu:///system')
-        storage = self.get_storage(image, conn)
-        storage.refresh(0)
-
-        try:
-            volume = storage.storageVolLookupByName(image.libvirt_name)
-        except Exception as e:
-            raise TaskFatalError('libvirt_image_not_found', exception=e)
-
-        try:
-            remote = urllib.urlopen(task.get_prop('url'))
-        except Exception as e:
-            raise TaskError('url_not_found', exception=e)
+        with pool.local() as conn:
+            storage = self.get_storage(image, conn)
 
-        bytes = 0
-        while bytes < int(task.get_prop('size')):
-            data = remote.read(1024*250)
-            if len(data) == 0:
-                break
-            stream = conn.newStream(0)
-            volume.upload(stream, bytes, len(data), 0)
-            stream.send(data)
-            stream.finish()
-            bytes += len(data)
+            try:
+                volume = storage.storageVolLookupByName(image.libvirt_name)
+            except Exception as e:
+                raise TaskFatalError('libvirt_image_not_found', exception=e)
 
-            image = task.get_obj('Image')
-            image.set_prop('progress', float(bytes)/float(task.get_prop('size')))
+            checksums.forget(image)
+            image.set_prop('sha256', None)
             image.save()
 
-        remote.close()
+            source = self.find_duplicate(task, image)
+            if source is not None:
+                volume.delete(0)
+                try:
+                    volume = self.clone_duplicate(task, storage, source, image)
+                except:
+                    # Empty volume is created again, so the upload could be retried
+                    try:
+                        storage.handle.storageVolLookupByName(image.libvirt_name)
+                    except libvirt.libvirtError:
+                        storage.createXML(image.libvirt_xml(), 0)
+                    raise
 
-        log(msg="Rebasing image to no backend", tags=('agent', 'image', 'info'), context=task.logger_ctx)
-        if image.format in ['qcow2', 'qed']:
-            r = system.call(['sudo',
-                             'qemu-img', 'rebase',
-                             '-u',
-                             '-f', image.format,
-                             '-u',
-                             '-b', '',
-                             volume.path()], stderr=None, stdout=None)
-            if r != 0:
+                image = task.get_obj('Image')
+                checksums.register(image, task.get_prop('sha256'))
+                image.size = volume.info()[1]
+                image.set_state('ok')
+                image.save()
+                return
+
+            url = task.get_prop('url')
+            size = int(task.get_prop('size'))
+            sparse = transfer.sparse_enabled(task)
+            progress = ProgressReporter(image, size)
+
+            # Local files are read only from allowed directories, other files of the host are not available to users
+            path = local_import.source_path(url)
+            if path is None and not local_import.remote(url):
+                raise TaskError('image_url_not_allowed')
+
+            with Admission(task, storage=image.storage) as slot:
+                # Compressed files are decompressed by the regular path
+                if path is not None and compression.from_url(url) is None:
+                    with open(path, 'rb') as f:
+                        if compression.from_magic(f.read(compression.INPUT_SIZE)) is None:
+                            self.import_local(task, image, volume, path, size, sparse)
+                            return
+
+                try:
+                    if compression.from_url(url) is None and ranged_download.supported(url, size):
+                        # Ranges are written in parallel, so they are not sparse (see transfer.upload)
+                        download = ranged_download.RangedDownload(url, size, 'upload_ranges:%s' % image.id)
+                        bytes = download.run(lambda offset, length, chunks, range_progress:
+                                             transfer.upload(conn, volume, slot.throttle(chunks, download.connections),
+                                                             offset, length, range_progress),
+                                             progress.update)
+                        # Ranges are downloaded out of order, so checksum is calculated from stored data
+                        digest = None
+                        if checksums.wanted(task):
+                            digest = checksums.volume_digest(conn, volume, size)
+                    else:
+                        sha = hashlib.sha256()
+                        bytes = self.download(conn, volume, url, size, progress, sparse, sha, slot)
+                        digest = sha.hexdigest()
+                    progress.finish(bytes)
+                except libvirt.libvirtError as e:
+                    raise TaskError('image_upload_failed', exception=e)
+
+            if task.get_prop('sha256') is not None and task.get_prop('sha256') != digest:
+                raise TaskError('image_checksum_mismatch')
+
+            if not self.rebase(task, image, volume):
                 image = task.get_obj('Image')
                 image.set_state('failed')
                 image.save()
-                conn.close()
                 return
 
-        storage.refresh(0)
+            image = task.get_obj('Image')
+            checksums.register(image, digest)
+            image.size = volume.info()[1]
+            image.set_state('ok')
+            image.save()
+
+
+    def import_local(self, task, image, volume, path, size, sparse):
+        """
+        Copy image from local file directly into volume's file. File cannot be larger than size given in task. Checksum
+        is calculated from the file only if it is expected by task.
+        """
+        if os.path.getsize(path) > size:
+            raise TaskError('image_too_large')
+
+        log(msg='Importing image from local file %s' % path, tags=('agent', 'image', 'info'), context=task.logger_ctx)
+
+        progress = ProgressReporter(image, size)
+        with watch(progress, lambda: volume.info()[2]):
+            copied = local_import.copy(path, volume, sparse)
+        if not copied:
+            raise TaskError('image_upload_failed')
+        progress.finish(progress.total)
+
+        digest = None
+        if task.get_prop('sha256') is not None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(transfer.chunk_size()), ''):
+                    sha.update(data)
+            digest = sha.hexdigest()
+            if task.get_prop('sha256') != digest:
+                raise TaskError('image_checksum_mismatch')
+
+        if not self.rebase(task, image, volume):
+            image = task.get_obj('Image')
+            image.set_state('failed')
+            image.save()
+            return
+
         image = task.get_obj('Image')
+        if digest is not None:
+            checksums.register(image, digest)
         image.size = volume.info()[1]
         image.set_state('ok')
         image.save()
-        conn.close()
 
 
     def upload_data(self, task):
         '''
         Put file given in operation.data['filename'] into given image (operation.image)
-        at offset. The file can extend existing image. Operation.data should contain:
+        at offset. The file can extend existing image. Only data is written, image is
+        ready after finalize_upload task. Operation.data should contain:
         - action
         - offset
         - filename
@@ -175,51 +392,116 @@ class AgentThread(BaseAgent):
         if image.attached_to != None:
             raise TaskError('image_attached')
 
-        image.set_state('downloading')
-        image.save()
+        if not image.in_state('downloading'):
+            image.set_state('downloading')
+            image.save()
 
-        conn = libvirt.open('qemu:///system')
-        storage = self.get_storage(image, conn)
-        storage.refresh(0)
+        # Content of image is changed, so its checksum is unknown until whole image is uploaded
+        if image.get_prop('sha256') is not None:
+            checksums.forget(image)
+            image.set_prop('sha256', None)
+            image.save()
 
-        try:
-            volume = storage.storageVolLookupByName(image.libvirt_name)
-        except Exception as e:
-            raise TaskFatalError('libvirt_image_not_found', exception=e)
+        with pool.local() as conn:
+            storage = self.get_storage(image, conn)
+
+            try:
+                volume = storage.storageVolLookupByName(image.libvirt_name)
+            except Exception as e:
+                raise TaskFatalError('libvirt_image_not_found', exception=e)
+
+            lock = data_chunks.lock(image)
+            lock.acquire()
+            try:
+                try:
+                    data_chunk = DataChunk(cache_key=task.get_prop('chunk_id'))
+                except Exception:
+                    log(msg='Chunk %s was already uploaded with previous chunks' % task.get_prop('chunk_id'),
+                        tags=('agent', 'image', 'info'),
+                        context=task.logger_ctx)
+                    return
+
+                # Write all waiting chunks, which continue this one, in one stream. Chunks are written as they are,
+                # compressed images are decompressed only by upload_url
+                run = data_chunks.contiguous(image, data_chunk)
+                chunks = data_chunks.read(run, data_chunk)
+
+                try:
+                    with Admission(task, storage=image.storage) as slot:
+                        transfer.upload(conn, volume, slot.throttle(chunks),
+                                        offset=run[0][2],
+                                        length=sum([length for key, chunk, offset, length in run]))
+                except libvirt.libvirtError as e:
+                    raise TaskError('image_upload_failed', exception=e)
+
+                for key, chunk, offset, length in run:
+                    data_chunks.record(image, offset, length)
+                for key, chunk, offset, length in run:
+                    data_chunks.delete(key, chunk)
+            finally:
+                lock.release()
+
+            if len(run) > 1:
+                log(msg='Uploaded %d chunks of image %s in one stream' % (len(run), image.id),
+                    tags=('agent', 'image', 'debug'),
+                    context=task.logger_ctx)
+
+        progress = ProgressReporter(image, image.size)
+        progress.finish(data_chunks.received_bytes(image))
+
+
+    def finalize_upload(self, task):
+        '''
+        Finish upload of image by data chunks. Task is delayed until all chunks are
+        written. Operation.data may contain:
+        - size - expected size of uploaded data. Without it, only gaps between chunks
+          are checked
+        - sha256 - expected SHA-256 of uploaded data. Data is read again to check it
+          only if it is given or LIBVIRT_IMAGE_DIGESTS is enabled
+        '''
+        image = task.get_obj('Image')
 
-        data_chunk = DataChunk(cache_key=task.get_prop('chunk_id'))
-        data = base64.b64decode(data_chunk.data)
+        size = task.get_prop('size')
+        if size is not None:
+            size = int(size)
 
-        stream = conn.newStream(0)
-        volume.upload(stream, int(data_chunk.offset), len(data), 0)
-        stream.send(data)
-        stream.finish()
+        received = data_chunks.received(image)
+        if size is None and len(received) == 0:
+            raise TaskNotReady('upload_incomplete')
 
-        data_chunk.delete()
+        missing = data_chunks.missing(image, size)
+        if len(missing) > 0:
+            raise TaskNotReady('upload_incomplete')
 
-        log(msg="Rebasing image to no backend", tags=('agent', 'image', 'info'), context=task.logger_ctx)
-        if image.format in ['qcow2', 'qed']:
-            r = system.call(['sudo',
-                             'qemu-img', 'rebase',
-                             '-u',
-                             '-f', image.format,
-                             '-u',
-                             '-b', '',
-                             volume.path()], stderr=None, stdout=None)
-            if r != 0:
-                image = task.get_obj('Image')
-                image.set_state('failed')
-                image.save()
-                conn.close()
-                return
+        if size is None:
+            size = max([offset + length for offset, length in received])
 
-        storage.refresh(0)
-        image = task.get_obj('Image')
-        image.size = volume.info()[1]
-        image.set_state('ok')
-        image.save()
+        with pool.local() as conn:
+            storage = self.get_storage(image, conn)
+
+            try:
+                volume = storage.storageVolLookupByName(image.libvirt_name)
+            except Exception as e:
+                raise TaskFatalError('libvirt_image_not_found', exception=e)
 
-        conn.close()
+            digest = None
+            if checksums.wanted(task):
+                digest = checksums.volume_digest(conn, volume, size)
+            if task.get_prop('sha256') is not None and task.get_prop('sha256') != digest:
+                raise TaskError('image_checksum_mismatch')
+
+            if not self.rebase(task, image, volume):
+                raise TaskError('image_rebase_failed')
+
+            storage.refresh(0)
+
+            image = task.get_obj('Image')
+            checksums.register(image, digest)
+            image.size = volume.info()[1]
+            image.set_state('ok')
+            image.save()
+
+        data_chunks.clear(image)
 
 
     def delete(self, task):
@@ -232,21 +514,35 @@ class AgentThread(BaseAgent):
                 task.ignore_errors = True
                 raise TaskError('image_attached')
 
-        conn = libvirt.open('qemu:///system')
-        storage = self.get_storage(image, conn)
+        # Volume is written by save_image now
+        if copy_jobs.running(image.id):
+            raise TaskNotReady('image_saving')
 
-        try:
-            volume = storage.storageVolLookupByName(image.libvirt_name)
-            volume.delete(0)
-        except Exception as e:
-            log(msg='Image doesn\'t exists. Skipping', exception=e, tags=('agent', 'image', 'error'), context=task.logger_ctx)
+        checksums.forget(image)
+        data_chunks.clear(image)
+
+        with pool.local() as conn:
+            storage = self.get_storage(image, conn)
+
+            try:
+                volume = storage.storageVolLookupByName(image.libvirt_name)
+            except Exception as e:
+                volume = None
+                log(msg='Image doesn\'t exists. Skipping', exception=e, tags=('agent', 'image', 'error'), context=task.logger_ctx)
+
+            if volume is not None:
+                # Images saved from vms could keep this image as their backing file. All volumes are checked only
+                # if such image was saved
+                if image.get_prop('overlays') and not task.ignore_errors and len(provisioning.backed_by(storage, volume)) > 0:
+                    raise TaskError('image_used_as_backing')
+
+                # Volume is removed in background by reaper agent
+                reaper.schedule(None, image.storage.name, image.libvirt_name)
 
         image = task.get_obj('Image')
         image.set_state('deleted')
         image.save()
 
-        conn.close()
-
 
     def attach(self, task):
         vm = task.get_obj('VM')
@@ -254,38 +550,58 @@ class AgentThread(BaseAgent):
         vm.node.check_online(task.ignore_errors)
 
         image = task.get_obj('Image')
-        conn = vm.node.libvirt_conn()
-
-        storage = conn.storagePoolLookupByName(image.storage.name)
-        storage.refresh(0)
-
-        if image.attached_to != None and not image.attached_to.in_state('closed'):
-            raise TaskError('image_attached')
-
-        if not vm.in_state('stopped'):
-            raise TaskError('vm_not_stopped')
+        with pool.node(vm.node) as conn:
+            if image.attached_to != None and not image.attached_to.in_state('closed'):
+                raise TaskError('image_attached')
 
-        if not image.in_state('ok'):
-            raise TaskError('image_state')
+            if not vm.in_states(['stopped', 'running']):
+                raise TaskError('vm_not_stopped')
+
+            if not image.in_state('ok'):
+                raise TaskError('image_state')
+
+            # Running VM opens the disk at once, so image's storage has to be available at the node
+            if vm.in_state('running'):
+                try:
+                    storage = storages.get(conn, image.storage.name)
+                except Exception as e:
+                    raise TaskError('node_storage_not_found', exception=e)
+                if not storage.running:
+                    raise TaskError('node_storage_not_running')
+
+            devices = [i.disk_dev for i in vm.image_set.all()]
+            if 'device' in task.get_all_props().keys() and not int(task.get_prop('device')) in devices:
+                disk_dev = int(task.get_prop('device'))
+            else:
+                disk_dev = 1
+                while disk_dev in devices:
+                    disk_dev = disk_dev+1
 
-        devices = [i.disk_dev for i in vm.image_set.all()]
-        if 'device' in task.get_all_props().keys() and not int(task.get_prop('device')) in devices:
-            disk_dev = int(task.get_prop('device'))
-        else:
-            disk_dev = 1
-            while disk_dev in devices:
-                disk_dev = disk_dev+1
+            image = task.get_obj('Image')
+            image.disk_dev = disk_dev
+            image.attached_to = vm
+            image.save()
 
-        image = task.get_obj('Image')
-        image.disk_dev = disk_dev
-        image.attached_to = vm
-        image.save()
+            device = Device.create(image.id, vm, 'devices/image.xml', {'img': image, 'disk_dev': 'sd' + chr(ord('a')+disk_dev)})
 
-        Device.create(image.id, vm, 'devices/image.xml', {'img': image, 'disk_dev': 'sd' + chr(ord('a')+disk_dev)})
+            if vm.in_state('stopped'):
+                vm.libvirt_redefine()
+                return
 
-        vm.libvirt_redefine()
+            # Running VM gets the disk without restart. The persistent definition is updated too, so the disk stays
+            # attached after the next start.
+            try:
+                domain = conn.lookupByName(vm.libvirt_name)
+                domain.attachDeviceFlags(device.xml, libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+            except libvirt.libvirtError as e:
+                device.delete()
+                image.attached_to = None
+                image.save()
+                raise TaskError('image_attach_failed', exception=e)
 
-        conn.close()
+            log(msg='Attached image %s to running vm %s' % (image.id, vm.id),
+                tags=('agent', 'image', 'info'),
+                context=task.logger_ctx)
 
 
     def detach(self, task):
@@ -295,7 +611,10 @@ class AgentThread(BaseAgent):
 
         image = task.get_obj('Image')
 
-        conn = vm.node.libvirt_conn()
+        if vm.in_state('running'):
+            self.detach_live(task, vm, image)
+            return
+
         if not vm.in_states(['stopped', 'closing', 'closed']) and not task.ignore_errors:
             raise TaskError('vm_not_stopped')
 
@@ -310,4 +629,28 @@ class AgentThread(BaseAgent):
         except:
             pass
 
-        conn.close()
+
+    def detach_live(self, task, vm, image):
+        """
+        Remove disk from running vm and from its persistent definition. Other devices are not touched.
+        """
+        with pool.node(vm.node) as conn:
+            try:
+                domain = conn.lookupByName(vm.libvirt_name)
+            except libvirt.libvirtError as e:
+                raise TaskError('vm_not_found', exception=e)
+
+            for device in Device.objects.filter(object_id=image.id, vm=vm).all():
+                try:
+                    domain.detachDeviceFlags(device.xml, libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+                except libvirt.libvirtError as e:
+                    if not task.ignore_errors:
+                        raise TaskError('image_detach_failed', exception=e)
+                device.delete()
+
+        image.attached_to = None
+        image.save()
+
+        log(msg='Detached image %s from running vm %s' % (image.id, vm.id),
+            tags=('agent', 'image', 'info'),
+            context=task.logger_ctx)
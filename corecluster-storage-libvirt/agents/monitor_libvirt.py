@@ -0,0 +1,242 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import libvirt
+import threading
+
+from corecluster.models.core.node import Node
+from corecluster.models.core.storage import Storage
+from corecluster.models.core.vm import VM
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+from ..utils.connection_pool import LOCAL_URI
+from ..utils.pool_cache import storages
+from ..utils import domains
+from ..utils.workers import LoopAgent
+
+
+event_loop_lock = threading.Lock()
+event_loop = None
+
+
+def start_event_loop():
+    """
+    Register libvirt's default event loop and run it in background thread. Should be called once per process, before
+    connections are opened.
+    """
+    global event_loop
+    event_loop_lock.acquire()
+    try:
+        if event_loop is not None:
+            return
+
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        event_loop = threading.Thread(target=run, name='libvirt-events')
+        event_loop.daemon = True
+        event_loop.start()
+    finally:
+        event_loop_lock.release()
+
+
+class AgentThread(LoopAgent):
+    """
+    Long-lived monitor of nodes and storages. It keeps one connection to each node and to local libvirt, receives
+    domain and storage pool lifecycle events and updates VM and Storage states. Lost connections are opened again and
+    states of all VMs at node are synchronized after each connect.
+    """
+    task_type = 'monitor'
+    supported_actions = []
+
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.connections = {}
+        self.callbacks = {}
+        self.closed = []
+        self.lock = threading.Lock()
+
+
+    def interval(self):
+        return int(config.get('agent', 'MONITOR_INTERVAL', 10))
+
+
+    def domain_event(self, conn, dom, event, detail, node_id):
+        if event in [libvirt.VIR_DOMAIN_EVENT_STARTED, libvirt.VIR_DOMAIN_EVENT_RESUMED]:
+            state = 'running'
+        elif event in [libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_CRASHED]:
+            state = 'stopped'
+        else:
+            return
+
+        try:
+            name = dom.name()
+            vms = VM.objects.filter(node_id=node_id, state__in=domains.ACTIVE_STATES).only('id', 'state')
+            vm_ids = [vm.id for vm in vms if vm.libvirt_name == name and vm.state != state]
+            domains.set_vm_states(vm_ids, state)
+        except Exception as e:
+            log(msg='Failed to handle domain event', exception=e, tags=('agent', 'monitor', 'error'))
+
+
+    def pool_event(self, conn, pool, event, detail, node_id):
+        try:
+            name = pool.name()
+            storages.invalidate(conn, name)
+
+            if event in [libvirt.VIR_STORAGE_POOL_EVENT_STOPPED, libvirt.VIR_STORAGE_POOL_EVENT_UNDEFINED]:
+                if node_id is None:
+                    Storage.objects.filter(name=name, state='ok').update(state='locked')
+                log(msg='Storage pool %s stopped at %s' % (name, node_id or 'management'), tags=('agent', 'monitor', 'alert'))
+            elif event == libvirt.VIR_STORAGE_POOL_EVENT_STARTED and node_id is None:
+                Storage.objects.filter(name=name, state='locked').update(state='ok')
+        except Exception as e:
+            log(msg='Failed to handle storage pool event', exception=e, tags=('agent', 'monitor', 'error'))
+
+
+    def connection_closed(self, conn, reason, key):
+        """
+        Forget closed connection. It is released later by update_connections, because libvirt's callbacks cannot be
+        removed from inside of the callback.
+        """
+        log(msg='Monitor connection to %s closed (%d)' % (key, reason), tags=('agent', 'monitor', 'info'))
+        self.lock.acquire()
+        try:
+            if self.connections.get(key) is conn:
+                del self.connections[key]
+                self.closed.append((conn, self.callbacks.pop(key, [])))
+        finally:
+            self.lock.release()
+
+
+    def connect(self, key, opener, node_id):
+        conn = opener()
+        conn.setKeepAlive(5, 3)
+        conn.registerCloseCallback(self.connection_closed, key)
+
+        callbacks = []
+        callbacks.append(conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.domain_event, node_id))
+        if hasattr(conn, 'storagePoolEventRegisterAny'):
+            callbacks.append(conn.storagePoolEventRegisterAny(None, libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE, self.pool_event, node_id))
+
+        self.lock.acquire()
+        try:
+            self.connections[key] = conn
+            self.callbacks[key] = callbacks
+        finally:
+            self.lock.release()
+        return conn
+
+
+    def disconnect(self, key):
+        self.lock.acquire()
+        try:
+            conn = self.connections.pop(key, None)
+            callbacks = self.callbacks.pop(key, [])
+        finally:
+            self.lock.release()
+
+        if conn is None:
+            return
+
+        self.release(conn, callbacks)
+
+
+    def release(self, conn, callbacks):
+        """
+        Deregister callbacks of connection and close it
+        """
+        try:
+            conn.domainEventDeregisterAny(callbacks[0])
+            if len(callbacks) > 1:
+                conn.storagePoolEventDeregisterAny(callbacks[1])
+        except Exception:
+            pass
+
+        try:
+            conn.unregisterCloseCallback()
+            conn.close()
+        except Exception:
+            pass
+
+
+    def update_connections(self):
+        self.lock.acquire()
+        try:
+            closed = self.closed
+            self.closed = []
+        finally:
+            self.lock.release()
+
+        for conn, callbacks in closed:
+            self.release(conn, callbacks)
+
+        if LOCAL_URI not in self.connections:
+            try:
+                self.connect(LOCAL_URI, lambda: libvirt.open(LOCAL_URI), None)
+            except Exception as e:
+                log(msg='Cannot connect to local libvirt', exception=e, tags=('agent', 'monitor', 'error'))
+
+        nodes = Node.objects.filter(state='ok')
+        node_ids = [node.id for node in nodes]
+
+        for key in list(self.connections.keys()):
+            if key != LOCAL_URI and key not in node_ids:
+                self.disconnect(key)
+
+        for node in nodes:
+            if node.id in self.connections:
+                continue
+
+            try:
+                conn = self.connect(node.id, node.libvirt_conn, node.id)
+                domains.sync_vm_states(node, domains.running_domains(conn))
+                log(msg='Monitoring node %s' % node.address, tags=('agent', 'monitor', 'info'))
+            except Exception as e:
+                log(msg='Cannot monitor node %s' % node.address, exception=e, tags=('agent', 'monitor', 'error'))
+
+
+    def prepare(self):
+        start_event_loop()
+
+
+    def tick(self):
+        try:
+            self.update_connections()
+        except Exception as e:
+            log(msg='Failed to update monitored nodes', exception=e, tags=('agent', 'monitor', 'error'))
+        return False
+
+
+    def finish(self):
+        for key in list(self.connections.keys()):
+            self.disconnect(key)
@@ -27,46 +27,52 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import Queue
 import libvirt
-import re
+import threading
 import time
 
+from django.db import connection
 from corecluster.models.core.vm import VM
+from corecluster.models.core.image import Image
 from ..agents.storage_libvirt import AgentThread as StorageAgent
-from corecluster.agents.base_agent import BaseAgent
 from corecluster.exceptions.agent import *
 from corenetwork.utils.logger import log
 from corenetwork.utils import system, config
+from ..utils.connection_pool import pool, node_uri
+from ..utils.pool_cache import storages
+from ..utils.progress import ProgressReporter, watch
+from ..utils.admission import Admission
+from ..utils import admission
+from ..utils import provisioning, image_cache, domains, copy_jobs, reaper
+from ..utils.workers import PooledAgent
 
 
-class AgentThread(BaseAgent):
+class AgentThread(PooledAgent):
     node = None
     task_type = 'node'
-    supported_actions = ['load_image', 'delete', 'save_image', 'mount', 'umount', 'create_images_pool', 'check', 'suspend', 'wake_up', 'resize_image']
+    supported_actions = ['load_image', 'load_images', 'delete', 'save_image', 'cancel_save', 'mount', 'umount', 'create_images_pool', 'check', 'suspend', 'wake_up', 'resize_image', 'prefetch']
+    long_actions = ['load_image', 'load_images', 'prefetch']
 
 
     def get_storage(self, name, conn):
         try:
-            storage = conn.storagePoolLookupByName(name)
+            storage = storages.get(conn, name)
         except Exception as e:
             raise TaskFatalError("node_storage_not_found", exception=e)
 
-        if storage.info()[0] != libvirt.VIR_STORAGE_POOL_RUNNING:
+        if not storage.running:
             raise TaskFatalError("node_storage_not_running")
 
-        storage.refresh(0)
+        storage.refresh_if_stale()
         return storage
 
 
-    def load_image(self, task):
-        node = task.get_obj('Node')
-
-        node.check_online(task.ignore_errors)
-
-        image = task.get_obj('Image')
-        vm = task.get_obj('VM')
-
-        conn = node.libvirt_conn()
+    def prepare_load(self, task, conn, node, image):
+        """
+        Find base volume of image (or its cached copy) and images pool of node. Returns images pool, base volume and
+        provisioning mode of VM disks.
+        """
         if image.state != 'ok':
             raise TaskNotReady('image_wrong_state')
 
@@ -76,29 +82,124 @@ class AgentThread(BaseAgent):
         try:
             base_volume = src_storage.storageVolLookupByName(image.libvirt_name)
         except Exception as e:
-            conn.close()
             raise TaskError('node_load_image_not_found', e)
 
-        new_volume_xml = base_volume.XMLDesc(0)
-        new_volume_xml = new_volume_xml.replace('<name>%s</name>' % (image.libvirt_name),
-                                                '<name>%s</name>' % str(vm.id))
-        new_volume_xml = re.sub(r'<group>[0-9\.]+</group>', '', new_volume_xml)
-        new_volume_xml = re.sub(r'<owner>[0-9\.]+</owner>', '', new_volume_xml)
+        if image_cache.enabled():
+            image_cache.record_load(image.id)
+            base_volume = image_cache.fetch(conn, node, image, base_volume)
 
-        try:
-            dest_storage.createXMLFrom(new_volume_xml, base_volume, 0)
-        except Exception as e:
-            vm.set_state('failed')
-            vm.save()
-            conn.close()
-            raise TaskFatalError('node_load_image_failed', exception=e)
+        provisioning_mode = provisioning.mode(task)
+        if provisioning_mode == 'overlay' and image.format != 'qcow2':
+            # VM's disk is defined with format of its base image, so overlay is possible only for qcow2 images
+            log(msg='Cannot create overlay over %s image. Copying' % image.format, tags=('agent', 'node', 'info'), context=task.logger_ctx)
+            provisioning_mode = 'copy'
+
+        return dest_storage, base_volume, provisioning_mode
+
+
+    def load_image(self, task):
+        node = task.get_obj('Node')
+
+        node.check_online(task.ignore_errors)
+
+        image = task.get_obj('Image')
+        vm = task.get_obj('VM')
 
-        conn.close()
+        with Admission(task, storage=image.storage, node=node):
+            with pool.node(node) as conn:
+                dest_storage, base_volume, provisioning_mode = self.prepare_load(task, conn, node, image)
+
+                progress = ProgressReporter(vm, base_volume.info()[2])
+                try:
+                    with watch(progress, lambda: dest_storage.handle.storageVolLookupByName(str(vm.id)).info()[2]):
+                        provisioning.clone(dest_storage, base_volume, str(vm.id), provisioning_mode, image.format)
+                    progress.finish(progress.total)
+                except Exception as e:
+                    vm.set_state('failed')
+                    vm.save()
+                    raise TaskFatalError('node_load_image_failed', exception=e)
+
+
+    def load_images(self, task):
+        """
+        Create disks of many VMs from one image. Task should contain Node and Image objects and list of VM ids in vm_ids
+        property. Base volume is prepared once and disks are cloned in up to LIBVIRT_BATCH_CLONES parallel threads, each
+        holding its own I/O slot. Result of each clone is stored in results property of task. Task fails only if all
+        clones failed.
+        """
+        node = task.get_obj('Node')
+
+        node.check_online(task.ignore_errors)
+
+        image = task.get_obj('Image')
+        vm_ids = task.get_prop('vm_ids', [])
+        vms = list(VM.objects.filter(id__in=vm_ids, node=node))
+
+        # VMs, which don't exist or are not at this node, are failed
+        results = {}
+        for vm_id in set(vm_ids) - set([vm.id for vm in vms]):
+            log(msg='VM %s is not at node %s' % (vm_id, node.id), tags=('agent', 'node', 'error'), context=task.logger_ctx)
+            results[vm_id] = 'node_vm_not_found'
+
+        with Admission(task, storage=image.storage, node=node):
+            with pool.node(node) as conn:
+                dest_storage, base_volume, provisioning_mode = self.prepare_load(task, conn, node, image)
+                xml = provisioning.volume_xml(base_volume, provisioning_mode, image.format)
+
+                queue = Queue.Queue()
+                for vm in vms:
+                    queue.put(vm)
+
+                def clone(slot):
+                    try:
+                        while True:
+                            try:
+                                vm = queue.get_nowait()
+                            except Queue.Empty:
+                                return
+
+                            try:
+                                provisioning.clone(dest_storage, base_volume, str(vm.id), provisioning_mode, image.format, xml)
+                                progress = ProgressReporter(vm, 1)
+                                progress.finish(1)
+                                results[vm.id] = 'ok'
+                            except Exception as e:
+                                log(msg='Failed to load image for VM %s' % vm.id, exception=e, tags=('agent', 'node', 'error'), context=task.logger_ctx)
+                                vm.set_state('failed')
+                                vm.save()
+                                results[vm.id] = str(e)
+                    finally:
+                        if slot is not None:
+                            slot.release()
+                        connection.close()
+
+                # First thread uses slot of the task. Next threads are started only while there are free slots, so
+                # the batch doesn't run more copies than LIBVIRT_STORAGE_IO_JOBS and LIBVIRT_NODE_IO_JOBS allow
+                workers = []
+                for i in range(min(int(config.get('agent', 'LIBVIRT_BATCH_CLONES', 4)), len(vms))):
+                    slot = None
+                    if i > 0:
+                        try:
+                            slot = Admission(task, storage=image.storage, node=node, part=i)
+                        except TaskNotReady:
+                            break
+                    worker = threading.Thread(target=clone, args=(slot,))
+                    worker.start()
+                    workers.append(worker)
+
+                for worker in workers:
+                    worker.join()
+
+        task.set_prop('results', results)
+        task.save()
+
+        if len(results) > 0 and 'ok' not in results.values():
+            raise TaskError('node_load_images_failed')
 
 
     def delete(self, task):
         '''
-        Delete volume
+        Delete volume of vm. Volume is removed later by reaper agent
         '''
         node = task.get_obj('Node')
         node.check_online(task.ignore_errors)
@@ -106,24 +207,57 @@ class AgentThread(BaseAgent):
         if vm.state not in ['stopped', 'closed', 'closing'] and not task.ignore_errors:
             raise TaskNotReady('vm_not_stopped')
 
-        conn = node.libvirt_conn()
+        # Volume is removed in background by reaper agent
+        reaper.schedule(node, 'images', str(vm.id))
+        log(msg='Volume of vm %s queued for removal' % vm.id, tags=('agent', 'node', 'info'), context=task.logger_ctx)
+
+
+    def init(self):
+        super(AgentThread, self).init()
+        self.recover_saves()
+
+
+    def recover_saves(self):
+        """
+        Cleanup after saves, which were copied by previous agent process at this host. VM is stopped again, image is
+        failed and I/O slot of copy is released.
+        """
+        for image_id, info in copy_jobs.lost():
+            log(msg='Save of image %s was interrupted' % image_id, tags=('agent', 'node', 'alert'))
+            try:
+                VM.objects.filter(id=info.get('vm_id'), state='saving').update(state='stopped')
+                Image.objects.filter(id=image_id, state='downloading').update(state='failed')
+                admission.release(info.get('slot_token'), info.get('slot_keys', []))
+            except Exception as e:
+                log(msg='Cannot cleanup save of image %s' % image_id, exception=e, tags=('agent', 'node', 'error'))
+                continue
+            copy_jobs.forget(image_id)
+
+
+    def overlay_base(self, vm, image, storage, volume):
+        """
+        Get volume of vm's base image if vm's disk is qcow2 overlay over it and the base image is in storage, where vm
+        is saved. Otherwise returns None.
+        """
+        path = provisioning.backing_path(volume)
+        if path is None or vm.base_image is None or vm.base_image.storage_id != image.storage_id:
+            return None
 
         try:
-            storage = self.get_storage('images', conn)
-        except Exception as e:
-            log(msg="Cannot get images storage", exception=e, tags=('error', 'agent', 'node'), context=task.logger_ctx)
-            conn.close()
-            raise TaskError('node_storage_get')
-        try:
-            volume = storage.storageVolLookupByName("%s" % (vm.id))
-            volume.delete(0)
-        except Exception as e:
-            log(msg="Image %s not found. Skipping" % vm.id, exception=e, tags=('alert', 'agent', 'node'), context=task.logger_ctx)
+            base_volume = storage.storageVolLookupByName(vm.base_image.libvirt_name)
+        except libvirt.libvirtError:
+            return None
 
-        conn.close()
+        if base_volume.path() != path:
+            return None
+        return base_volume
 
 
     def save_image(self, task):
+        """
+        Save VM's disk as image. Copy is done by background job, so this task finishes when copy is started. VM is kept
+        in saving state until copy is finished. Copy could be cancelled by cancel_save task.
+        """
         node = task.get_obj('Node')
 
         node.check_online(task.ignore_errors)
@@ -133,35 +267,108 @@ class AgentThread(BaseAgent):
         if not vm.in_state('stopped'):
             raise TaskNotReady('vm_not_stopped')
 
-        vm.set_state('saving')
-        vm.save()
+        with pool.node(node) as conn:
+            self.get_storage(image.storage.name, conn)
+            src_storage = self.get_storage('images', conn)
 
-        conn = node.libvirt_conn()
-
-        dest_storage = self.get_storage(image.storage.name, conn)
-        src_storage = self.get_storage('images', conn)
+            try:
+                src_storage.storageVolLookupByName('%s' % vm.id)
+            except Exception as e:
+                raise TaskError('node_save_vm_image_not_found', exception=e)
+
+        # Slot is kept until background copy is finished
+        slot = Admission(task, storage=image.storage, node=node)
+
+        def copy(job):
+            with pool.node(node) as conn:
+                dest_storage = self.get_storage(image.storage.name, conn)
+                src_storage = self.get_storage('images', conn)
+                base_volume = src_storage.storageVolLookupByName('%s' % vm.id)
+                progress = ProgressReporter(image, base_volume.info()[2])
+
+                overlay_base = self.overlay_base(vm, image, dest_storage, base_volume)
+                if overlay_base is not None:
+                    # Only data changed by vm is copied. New image is backed by the same base image as vm's disk
+                    log(msg='Saving changes of vm %s over image %s' % (vm.id, vm.base_image.id), tags=('agent', 'node', 'info'), context=task.logger_ctx)
+
+                    # Delete of base image checks for overlays only if it is marked
+                    base_image = Image.objects.get(pk=vm.base_image.id)
+                    base_image.set_prop('overlays', True)
+                    base_image.save()
+
+                    def copied(bytes):
+                        job.check_cancelled()
+                        progress.update(bytes)
+
+                    provisioning.copy_overlay(conn, dest_storage, base_volume, image.libvirt_name, overlay_base, copied)
+                    image.format = 'qcow2'
+                else:
+                    with watch(progress, lambda: dest_storage.handle.storageVolLookupByName(image.libvirt_name).info()[2]):
+                        volume = dest_storage.createXMLFrom(image.libvirt_xml(), base_volume, 0)
+
+                    if job.cancelled:
+                        volume.delete(0)
+                        job.check_cancelled()
+
+                progress.finish(progress.total)
+                image.size = base_volume.info()[1]
+
+        def finished():
+            slot.release()
+
+            saved = task.get_obj('VM')
+            saved.set_state('stopped')
+            saved.save()
+
+            saved = task.get_obj('Image')
+            if not saved.in_state('downloading'):
+                # Image was deleted while it was saved
+                log(msg='Image %s is %s. Removing saved volume' % (image.id, saved.state), tags=('agent', 'node', 'alert'), context=task.logger_ctx)
+                reaper.schedule(None, image.storage.name, image.libvirt_name)
+                return
+
+            saved.size = image.size
+            saved.format = image.format
+            saved.set_state('ok')
+            saved.save()
+            log(msg='VM %s saved as image %s' % (vm.id, image.id), tags=('agent', 'node', 'info'), context=task.logger_ctx)
+
+        def failed(exception):
+            slot.release()
+
+            saved = task.get_obj('VM')
+            saved.set_state('stopped')
+            saved.save()
+
+            saved = task.get_obj('Image')
+            if saved.in_state('downloading'):
+                saved.set_state('failed')
+                saved.save()
 
-        new_volume_xml = image.libvirt_xml()
         try:
-            base_volume = src_storage.storageVolLookupByName('%s' % vm.id)
-        except Exception as e:
-            conn.close()
-            raise TaskError('node_save_vm_image_not_found', exception=e)
+            vm.set_state('saving')
+            vm.save()
 
-        try:
-            dest_storage.createXMLFrom(new_volume_xml, base_volume, 0)
-        except Exception as e:
-            conn.close()
-            raise TaskError('node_image_save', exception=e)
+            # Image is not ready until copy is finished, even if task is
+            image.set_state('downloading')
+            image.save()
 
-        vm.set_state('stopped')
-        vm.save()
+            # Slot is refreshed while copy runs, so it doesn't expire after LIBVIRT_IO_SLOT_TIMEOUT
+            copy_jobs.start(image.id, copy, finished, failed, {'vm_id': vm.id,
+                                                              'slot_token': slot.token,
+                                                              'slot_keys': slot.keys}, slot.refresh)
+        except:
+            slot.release()
+            VM.objects.filter(id=vm.id, state='saving').update(state='stopped')
+            raise
 
-        image.size = base_volume.info()[1]
-        image.set_state('ok')
-        image.save()
 
-        conn.close()
+    def cancel_save(self, task):
+        """
+        Cancel saving VM's disk to image. Copy which is already running is finished and then removed
+        """
+        image = task.get_obj('Image')
+        copy_jobs.cancel(image.id)
 
 
     def resize_image(self, task):
@@ -169,7 +376,7 @@ class AgentThread(BaseAgent):
 
         vm.node.check_online(task.ignore_errors)
 
-        if not vm.in_states(['stopped']):
+        if not vm.in_states(['stopped', 'running']):
             raise TaskError('vm_not_stopped')
 
         image_size = int(task.get_prop('size'))
@@ -177,78 +384,123 @@ class AgentThread(BaseAgent):
         if image_size > vm.template.hdd*1024*1024:
             raise TaskError('vm_resize_over_template')
 
-        conn = vm.node.libvirt_conn()
-        pool = conn.storagePoolLookupByName('images')
-        vol = pool.storageVolLookupByName(vm.id)
-        vol.resize(image_size)
+        with pool.node(vm.node) as conn:
+            storage = self.get_storage('images', conn)
+            try:
+                vol = storage.storageVolLookupByName(str(vm.id))
+            except libvirt.libvirtError as e:
+                raise TaskFatalError('vm_volume_not_found', exception=e)
+
+            try:
+                if vm.in_state('stopped'):
+                    vol.resize(image_size)
+                else:
+                    # Running domain resizes the disk through qemu, so guest sees the new size at once. Shrinking
+                    # disk of running vm would destroy guest's data.
+                    if image_size < vol.info()[1]:
+                        raise TaskError('vm_resize_shrink')
+                    domain = conn.lookupByName(vm.libvirt_name)
+                    domain.blockResize(vol.path(), image_size, libvirt.VIR_DOMAIN_BLOCK_RESIZE_BYTES)
+            except libvirt.libvirtError as e:
+                raise TaskError('vm_resize_failed', exception=e)
+
+        log(msg='Resized disk of vm %s to %d bytes' % (vm.id, image_size),
+            tags=('agent', 'node', 'info'),
+            context=task.logger_ctx)
+
+
+    def prefetch(self, task):
+        """
+        Copy image to node's image cache before VMs are created from it. Up to LIBVIRT_PREFETCH_JOBS images are copied
+        at once by one agent process and LIBVIRT_NODE_PREFETCH_JOBS at one node. LIBVIRT_PREFETCH_RATE bytes per second
+        is shared by operations at the node.
+        """
+        node = task.get_obj('Node')
+
+        node.check_online(task.ignore_errors)
+
+        image = task.get_obj('Image')
+        if not image_cache.enabled():
+            raise TaskFatalError('node_image_cache_disabled')
+
+        if image.state != 'ok':
+            raise TaskNotReady('image_wrong_state')
+
+        slots = image_cache.prefetch_jobs()
+        if not slots.acquire(False):
+            raise TaskNotReady('node_prefetch_busy')
+
+        try:
+            with Admission(task, storage=image.storage, node=node) as slot:
+                slot.acquire('prefetch', node, int(config.get('agent', 'LIBVIRT_NODE_PREFETCH_JOBS', 1)), 'node_prefetch_busy')
+                with pool.node(node) as conn:
+                    src_storage = self.get_storage(image.storage.name, conn)
+                    try:
+                        base_volume = src_storage.storageVolLookupByName(image.libvirt_name)
+                    except Exception as e:
+                        raise TaskError('node_load_image_not_found', exception=e)
+
+                    # Prefetch rate is shared by all operations at the node. Throttled copy is streamed through the agent,
+                    # otherwise it is copied by the node
+                    throttle = None
+                    if image_cache.prefetch_rate() > 0:
+                        throttle = lambda chunks: slot.throttle(chunks, rate=lambda: slot.node_rate(image_cache.prefetch_rate()))
+                    image_cache.fetch(conn, node, image, base_volume, throttle)
+        finally:
+            slots.release()
+
+        log(msg='Image %s prefetched to node %s' % (image.id, node.id), tags=('agent', 'node', 'info'), context=task.logger_ctx)
 
 
     def mount(self, task):
         node = task.get_obj('Node')
-        conn = node.libvirt_conn()
-        StorageAgent.real_mount(task, conn)
-        conn.close()
+        with pool.node(node) as conn:
+            StorageAgent.real_mount(task, conn)
 
 
     def umount(self, task):
         node = task.get_obj('Node')
-        conn = node.libvirt_conn()
-        node.state = 'offline'
-        node.save()
-        StorageAgent.real_umount(task, conn)
-        conn.close()
+        with pool.node(node) as conn:
+            node.state = 'offline'
+            node.save()
+            StorageAgent.real_umount(task, conn)
 
 
     def create_images_pool(self, task):
         node = task.get_obj('Node')
 
-        conn = node.libvirt_conn()
-        try:
-            pool = conn.storagePoolLookupByName('images')
-            if pool.info()[0] != libvirt.VIR_STORAGE_POOL_RUNNING:
-                log('Trying to start existing pool', tags=('agent', 'node', 'info'), context=task.logger_ctx)
-                pool.build(0)
-                pool.create(0)
-            else:
-                log(msg='Images pool exists', tags=('agent', 'node', 'warning'), context=task.logger_ctx)
-        except:
-            log(msg='Images pool does not exists. Defining new', tags=('agent', 'node', 'info'), context=task.logger_ctx)
-            template = node.images_pool_template()
-            pool = conn.storagePoolDefineXML(template, 0)
-
+        with pool.node(node) as conn:
+            storages.invalidate(conn, 'images')
             try:
-                pool.build(0)
-            except Exception as e:
-                conn.close()
-                raise TaskFatalError('node_images_pool_build_failed', exception=e)
-
-            try:
-                pool.create(0)
-            except Exception as e:
-                conn.close()
-                raise TaskFatalError('node_images_pool_failed', exception=e)
-        conn.close()
+                images = conn.storagePoolLookupByName('images')
+                if images.info()[0] != libvirt.VIR_STORAGE_POOL_RUNNING:
+                    log('Trying to start existing pool', tags=('agent', 'node', 'info'), context=task.logger_ctx)
+                    images.build(0)
+                    images.create(0)
+                else:
+                    log(msg='Images pool exists', tags=('agent', 'node', 'warning'), context=task.logger_ctx)
+            except:
+                log(msg='Images pool does not exists. Defining new', tags=('agent', 'node', 'info'), context=task.logger_ctx)
+                template = node.images_pool_template()
+                images = conn.storagePoolDefineXML(template, 0)
+
+                try:
+                    images.build(0)
+                except Exception as e:
+                    raise TaskFatalError('node_images_pool_build_failed', exception=e)
+
+                try:
+                    images.create(0)
+                except Exception as e:
+                    raise TaskFatalError('node_images_pool_failed', exception=e)
 
 
     def check(self, task):
         node = task.get_obj('Node')
-        conn = node.libvirt_conn()
+        with pool.node(node) as conn:
+            running = domains.running_domains(conn)
 
-        for vm in node.vm_set.filter(state__in=['running', 'starting']):
-            try:
-                libvirt_vm = conn.lookupByName(vm.libvirt_name)
-            except Exception as e:
-                vm.set_state('stopped')
-                vm.save()
-                log(msg='Failed to find VM %s at node %s' % (vm.id, vm.node.address), exception=e, tags=('agent', 'node', 'error'), context=task.logger_ctx)
-
-            if libvirt_vm.state()[0] == libvirt.VIR_DOMAIN_RUNNING:
-                vm.set_state('running')
-                vm.save()
-            else:
-                vm.set_state('stopped')
-                vm.save()
-        conn.close()
+        domains.sync_vm_states(node, running, task.logger_ctx)
 
         node.state = 'ok'
         node.save()
@@ -281,9 +533,9 @@ class AgentThread(BaseAgent):
 
         node.save()
 
-        conn = node.libvirt_conn()
-        conn.suspendForDuration(libvirt.VIR_NODE_SUSPEND_TARGET_MEM, config.get('core', 'NODE_SUSPEND_DURATION'))
-        conn.close()
+        with pool.node(node) as conn:
+            conn.suspendForDuration(libvirt.VIR_NODE_SUSPEND_TARGET_MEM, config.get('core', 'NODE_SUSPEND_DURATION'))
+        pool.close_all(node_uri(node))
 
 
     def wake_up(self, task):
@@ -0,0 +1,72 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+
+import time
+
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+from ..utils import reaper
+from ..utils.workers import LoopAgent
+
+
+class AgentThread(LoopAgent):
+    """
+    Background removal of volumes. Volumes queued by delete tasks are removed every LIBVIRT_REAPER_INTERVAL seconds,
+    so agents' workers don't wait for slow deletes. Pools are swept for orphaned volumes every LIBVIRT_SWEEP_INTERVAL
+    seconds.
+    """
+    task_type = 'reaper'
+    supported_actions = []
+
+
+    def interval(self):
+        return int(config.get('agent', 'LIBVIRT_REAPER_INTERVAL', 30))
+
+
+    def prepare(self):
+        self.swept = 0
+
+
+    def tick(self):
+        try:
+            removed = reaper.reap()
+            if removed > 0:
+                log(msg='Removed %d volumes' % removed, tags=('agent', 'reaper', 'info'))
+        except Exception as e:
+            log(msg='Failed to remove volumes', exception=e, tags=('agent', 'reaper', 'error'))
+
+        if time.time() - self.swept > int(config.get('agent', 'LIBVIRT_SWEEP_INTERVAL', 3600)):
+            self.swept = time.time()
+            try:
+                reaper.sweep()
+            except Exception as e:
+                log(msg='Failed to sweep pools', exception=e, tags=('agent', 'reaper', 'error'))
+        return False
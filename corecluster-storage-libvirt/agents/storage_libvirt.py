@@ -30,12 +30,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import libvirt
 import os
 
-from corecluster.agents.base_agent import BaseAgent
 from corecluster.exceptions.agent import *
 from corenetwork.utils.logger import log
+from ..utils.connection_pool import pool
+from ..utils.pool_cache import storages
+from ..utils.workers import PooledAgent
 
 
-class AgentThread(BaseAgent):
+class AgentThread(PooledAgent):
     storage = None
     task_type = 'storage'
     supported_actions = ['mount', 'umount']
@@ -62,9 +64,8 @@ class AgentThread(BaseAgent):
 
 
     def mount(self, task):
-        conn = libvirt.open('qemu:///system')
-        AgentThread.real_mount(task, conn)
-        conn.close()
+        with pool.local() as conn:
+            AgentThread.real_mount(task, conn)
 
 
     @staticmethod
@@ -79,6 +80,7 @@ class AgentThread(BaseAgent):
 
         storage.set_state('locked')
         storage.save()
+        storages.invalidate(conn, storage.name)
 
         #TODO: Do it better, unless Libvirt doesnt create new directory via storage.build
         if storage.transport == 'netfs':
@@ -139,12 +141,11 @@ class AgentThread(BaseAgent):
 
 
     def umount(self, operation):
-        conn = libvirt.open('qemu:///system')
-        AgentThread.real_mount(operation, conn)
+        with pool.local() as conn:
+            AgentThread.real_mount(operation, conn)
 
         operation.storage.state = 'locked'
         operation.storage.save()
-        conn.close()
 
 
     @staticmethod
@@ -153,6 +154,7 @@ class AgentThread(BaseAgent):
         As above, this function mounts storage by connection. This could be used by Storage or Node agents
         """
         storage = task.get_obj('Storage')
+        storages.invalidate(conn, storage.name)
 
         try:
             lv_storage = conn.storagePoolLookupByName(storage.name)
@@ -170,5 +172,4 @@ class AgentThread(BaseAgent):
         except Exception as e:
             storage.state = 'locked'
             storage.save()
-            conn.close()
             raise TaskError('storage_undefine', exception=e)
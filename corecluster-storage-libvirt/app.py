@@ -1,8 +1,13 @@
 MODULE = {
+    'hooks': {
+        'cron.minute': ['corecluster-storage-libvirt.hooks.prefetch'],
+    },
     'agents': [
-        {'type': 'image', 'module': 'corecluster-storage-libvirt.agents.image_libvirt', 'count': 4},
-        {'type': 'node', 'module': 'corecluster-storage-libvirt.agents.node_libvirt', 'count': 4},
-        {'type': 'storage', 'module': 'corecluster-storage-libvirt.agents.storage_libvirt', 'count': 4},
+        {'type': 'image', 'module': 'corecluster-storage-libvirt.agents.image_libvirt', 'count': 1},
+        {'type': 'node', 'module': 'corecluster-storage-libvirt.agents.node_libvirt', 'count': 1},
+        {'type': 'storage', 'module': 'corecluster-storage-libvirt.agents.storage_libvirt', 'count': 1},
+        {'type': 'monitor', 'module': 'corecluster-storage-libvirt.agents.monitor_libvirt', 'count': 1},
+        {'type': 'reaper', 'module': 'corecluster-storage-libvirt.agents.reaper_libvirt', 'count': 1},
     ],
     'drivers': {
         
@@ -0,0 +1,65 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+
+from corenetwork.hook_interface import HookInterface
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+from corecluster.cache.task import Task
+from corecluster.models.core import Image, Node
+from ..utils import image_cache
+
+
+class Hook(HookInterface):
+    """
+    Prefetch images, which were often loaded recently, to all nodes. Enabled by LIBVIRT_AUTO_PREFETCH in agent config
+    """
+    task = None
+
+    def cron(self, interval=None):
+        if not image_cache.enabled() or not config.get('agent', 'LIBVIRT_AUTO_PREFETCH', False):
+            return
+
+        for image_id in image_cache.popular():
+            image_cache.forget_loads(image_id)
+            try:
+                image = Image.objects.get(pk=image_id, state='ok')
+            except Image.DoesNotExist:
+                continue
+
+            for node in Node.objects.filter(state='ok'):
+                if image_cache.last_used(node, image.id) > 0:
+                    continue
+
+                log(msg='Prefetching image %s to node %s' % (image.id, node.id), tags=('node', 'hook'))
+                task = Task()
+                task.type = 'node'
+                task.action = 'prefetch'
+                task.append_to([node, image])
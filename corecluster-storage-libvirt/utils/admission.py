@@ -0,0 +1,217 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+
+import time
+import uuid
+
+from corecluster.cache import Cache
+from corecluster.exceptions.agent import *
+from corenetwork.utils import config
+
+
+def _key(kind, obj):
+    return 'io_slots:%s:%s' % (kind, obj.id)
+
+
+def _holders(key, timeout=None):
+    """
+    Count operations holding slots of key. Slots older than timeout (LIBVIRT_IO_SLOT_TIMEOUT by default) are left by
+    dead agents and are removed.
+    """
+    if timeout is None:
+        timeout = int(config.get('agent', 'LIBVIRT_IO_SLOT_TIMEOUT', 6*3600))
+    now = time.time()
+    holders = 0
+    for token in Cache.hkeys(key):
+        try:
+            started = float(Cache.hget(key, token))
+        except (TypeError, ValueError):
+            started = 0
+        if now - started > timeout:
+            Cache.hdel(key, token)
+        else:
+            holders += 1
+    return holders
+
+
+def _acquire(key, limit, token, timeout=None):
+    l = Cache.lock(key + ':lock')
+    l.acquire()
+    try:
+        if _holders(key, timeout) >= limit:
+            return False
+        Cache.hset(key, token, str(time.time()))
+        return True
+    finally:
+        l.release()
+
+
+def release(token, keys):
+    """
+    Release slots taken by operation. Used directly to cleanup slots of operations lost by stopped agents.
+    """
+    for key in keys:
+        Cache.hdel(key, token)
+
+
+class Admission(object):
+    """
+    Slot for heavy i/o operation (copy, upload, clone) at storage and node. Up to LIBVIRT_STORAGE_IO_JOBS operations
+    run at once at one storage and LIBVIRT_NODE_IO_JOBS at one node, in all agent processes. If there is no free slot,
+    TaskNotReady is raised, so the task is retried later and agent's thread is free for other tasks. Light operations
+    (create, delete) don't take slots, so they are never queued behind copies.
+
+    Streamed data could be passed through throttle, which shares LIBVIRT_STORAGE_BANDWIDTH equally between operations
+    at the storage.
+    """
+    def __init__(self, task, storage=None, node=None, part=None):
+        self.token = str(task.id)
+        if part is not None:
+            # Parallel parts of one task take separate slots
+            self.token += ':' + str(part)
+        self.keys = []
+        self.storage_key = None
+        self.node_key = None
+
+        if storage is not None:
+            self.storage_key = _key('storage', storage)
+            self._acquire(self.storage_key, int(config.get('agent', 'LIBVIRT_STORAGE_IO_JOBS', 2)), 'storage_busy')
+        if node is not None:
+            self.node_key = _key('node', node)
+            self._acquire(self.node_key, int(config.get('agent', 'LIBVIRT_NODE_IO_JOBS', 2)), 'node_busy')
+
+
+    def _acquire(self, key, limit, error):
+        if not _acquire(key, limit, self.token):
+            self.release()
+            raise TaskNotReady(error)
+        self.keys.append(key)
+
+
+    def acquire(self, kind, obj, limit, error):
+        """
+        Take additional slot of other kind (e.g. prefetch at node). It is released with other slots
+        """
+        self._acquire(_key(kind, obj), limit, error)
+
+
+    def refresh(self):
+        """
+        Mark slots as used now. Operations longer than LIBVIRT_IO_SLOT_TIMEOUT should call it, so their slots are not
+        taken as left by dead agents
+        """
+        for key in self.keys:
+            Cache.hset(key, self.token, str(time.time()))
+
+
+    def release(self):
+        release(self.token, self.keys)
+        self.keys = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+    def rate(self):
+        """
+        Current share of storage bandwidth, in bytes per second. 0 means no limit
+        """
+        bandwidth = int(config.get('agent', 'LIBVIRT_STORAGE_BANDWIDTH', 0))
+        if bandwidth == 0 or self.storage_key is None:
+            return 0
+        return bandwidth / max(len(Cache.hkeys(self.storage_key)), 1)
+
+
+    def node_rate(self, bandwidth):
+        """
+        Current share of node's bandwidth, shared by operations holding slots at the node, in bytes per second. 0 means
+        no limit
+        """
+        if bandwidth == 0 or self.node_key is None:
+            return bandwidth
+        return bandwidth / max(len(Cache.hkeys(self.node_key)), 1)
+
+
+    def throttle(self, chunks, streams=1, rate=None):
+        """
+        Pass chunks through not faster than current share of storage bandwidth (or limit returned by rate function).
+        Share is checked every second, so it follows operations starting and finishing at the storage. Operation sending
+        data by many parallel streams should pass their number, so they don't get more bandwidth together.
+        """
+        if rate is None:
+            rate = self.rate
+        limit = rate() / streams
+        checked = time.time()
+        for data in chunks:
+            sent = time.time()
+            yield data
+            if time.time() - checked > 1:
+                limit = rate() / streams
+                checked = time.time()
+            if limit > 0:
+                delay = float(len(data)) / limit - (time.time() - sent)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class Lock(object):
+    """
+    Lock shared by all agent processes. It is never waited for: TaskNotReady is raised if it is taken, so the task is
+    retried later. Lock left by stopped agent expires after timeout seconds (LIBVIRT_IO_SLOT_TIMEOUT by default).
+    """
+    def __init__(self, name, error, timeout=None):
+        self.key = 'locks:' + name
+        self.error = error
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+
+
+    def acquire(self):
+        if not _acquire(self.key, 1, self.token, self.timeout):
+            raise TaskNotReady(self.error)
+
+
+    def release(self):
+        Cache.hdel(self.key, self.token)
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.release()
@@ -0,0 +1,112 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import hashlib
+
+from corecluster.cache import Cache
+from corecluster.models.core.image import Image
+from corenetwork.utils import config
+from ..utils import transfer
+
+
+def hashed(chunks, sha):
+    """
+    Pass chunks through and update sha with their data
+    """
+    for data in chunks:
+        sha.update(data)
+        yield data
+
+
+def volume_digest(conn, volume, length=0):
+    """
+    Calculate SHA-256 of volume's content (or its first length bytes) by reading it through libvirt stream
+    """
+    sha = hashlib.sha256()
+    for data in transfer.download(conn, volume, length=length):
+        sha.update(data)
+    return sha.hexdigest()
+
+
+def wanted(task):
+    """
+    Check if digest should be calculated by reading stored volume again (ranged downloads and data chunks). It is done
+    only if task expects digest or LIBVIRT_IMAGE_DIGESTS is enabled, to index all images for deduplication.
+    """
+    return task.get_prop('sha256') is not None or bool(config.get('agent', 'LIBVIRT_IMAGE_DIGESTS', False))
+
+
+def _index_key(storage):
+    return 'image_digests:' + str(storage.id)
+
+
+def register(image, digest):
+    """
+    Store digest in image's properties and in index of images by digest in image's storage. Image is not saved. Digest
+    could be None, if it was not calculated.
+    """
+    image.set_prop('sha256', digest)
+    if digest is not None:
+        Cache.hset(_index_key(image.storage), digest, image.id)
+
+
+def forget(image):
+    """
+    Remove image from index (e.g. when it is deleted or its content is changed)
+    """
+    digest = image.get_prop('sha256')
+    if digest is not None and Cache.hget(_index_key(image.storage), digest) == image.id:
+        Cache.hdel(_index_key(image.storage), digest)
+
+
+def find(storage, digest, user_id, exclude=None):
+    """
+    Find image with given content in storage, which could be read by user. Returns None if there is no such image in ok
+    state.
+    """
+    image_id = Cache.hget(_index_key(storage), digest)
+    if image_id is None or image_id == exclude:
+        return None
+
+    # Digest is given by user, so it cannot be used to get copy of other user's private image
+    try:
+        Image.get(user_id, image_id)
+    except Exception:
+        return None
+
+    try:
+        image = Image.objects.get(pk=image_id)
+    except Image.DoesNotExist:
+        image = None
+
+    if image is None or image.storage_id != storage.id or not image.in_state('ok') or image.get_prop('sha256') != digest:
+        Cache.hdel(_index_key(storage), digest)
+        return None
+
+    return image
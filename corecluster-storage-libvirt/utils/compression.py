@@ -0,0 +1,199 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from corecluster.exceptions.agent import *
+
+
+MAGIC = [
+    ('gzip', '\x1f\x8b'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zstd', '\x28\xb5\x2f\xfd'),
+]
+
+EXTENSIONS = [
+    ('gzip', '.gz'),
+    ('xz', '.xz'),
+    ('zstd', '.zst'),
+]
+
+# Size of compressed blocks read from source. Decompressed data is limited by size of read, not by this size
+INPUT_SIZE = 16*1024
+
+
+def from_url(url):
+    """
+    Guess compression by extension of file in url
+    """
+    path = url.split('?')[0].lower()
+    for kind, extension in EXTENSIONS:
+        if path.endswith(extension):
+            return kind
+    return None
+
+
+def from_magic(data):
+    for kind, magic in MAGIC:
+        if data.startswith(magic):
+            return kind
+    return None
+
+
+def decompressor(kind):
+    """
+    Get decompressor of gzip or xz data, which could limit size of its output. Xz requires lzma module with max_length
+    support (Python 3.5 or newer)
+    """
+    if kind == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif kind == 'xz' and lzma is not None and hasattr(lzma.LZMADecompressor(), 'needs_input'):
+        return lzma.LZMADecompressor()
+    raise TaskError('compression_not_supported_%s' % kind)
+
+
+class PeekReader(object):
+    """
+    File-like wrapper, which allows to look at the beginning of source without consuming it
+    """
+    def __init__(self, source):
+        self.source = source
+        self.buffer = ''
+
+
+    def peek(self, size):
+        while len(self.buffer) < size:
+            data = self.source.read(size - len(self.buffer))
+            if len(data) == 0:
+                break
+            self.buffer += data
+        return self.buffer[:size]
+
+
+    def read(self, size):
+        if len(self.buffer) > 0:
+            data = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return data
+        return self.source.read(size)
+
+
+    def close(self):
+        self.source.close()
+
+
+class DecompressReader(object):
+    """
+    File-like object returning decompressed data of source. Decompressors never return more data than requested by
+    read, so memory usage doesn't depend on size of image nor on compression ratio.
+    """
+    def __init__(self, source, kind):
+        self.source = source
+        self.kind = kind
+        self.input = ''
+        self.eof = False
+
+        if kind == 'zstd':
+            if zstandard is None:
+                raise TaskError('compression_not_supported_zstd')
+            self.stream = zstandard.ZstdDecompressor().stream_reader(source)
+        else:
+            self.decompressor = decompressor(kind)
+
+
+    def _decompress(self, size):
+        """
+        Decompress at most size bytes. Source is read only when decompressor needs more input
+        """
+        if self.kind == 'zstd':
+            data = self.stream.read(size)
+            if len(data) == 0:
+                self.eof = True
+            return data
+
+        if self.kind == 'gzip':
+            if len(self.input) == 0:
+                self.input = self.source.read(INPUT_SIZE)
+                if len(self.input) == 0:
+                    self.eof = True
+                    return self.decompressor.flush()
+            data = self.decompressor.decompress(self.input, size)
+            self.input = self.decompressor.unconsumed_tail
+            return data
+
+        if self.decompressor.eof:
+            self.eof = True
+            return ''
+        if self.decompressor.needs_input:
+            self.input = self.source.read(INPUT_SIZE)
+            if len(self.input) == 0:
+                self.eof = True
+                return ''
+        else:
+            self.input = ''
+        return self.decompressor.decompress(self.input, size)
+
+
+    def read(self, size):
+        pieces = []
+        length = 0
+        while length < size and not self.eof:
+            data = self._decompress(size - length)
+            pieces.append(data)
+            length += len(data)
+        return ''.join(pieces)
+
+
+    def close(self):
+        self.source.close()
+
+
+def open_source(source):
+    """
+    Wrap file-like source by decompressing reader if data is compressed. Compression is detected by magic bytes.
+    Returns pair: reader and kind of compression (or None).
+    """
+    source = PeekReader(source)
+    kind = from_magic(source.peek(8))
+    if kind is None:
+        return source, None
+    return DecompressReader(source, kind), kind
@@ -0,0 +1,200 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import libvirt
+import threading
+import time
+from contextlib import contextmanager
+
+from corecluster.exceptions.agent import *
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+
+
+LOCAL_URI = 'qemu:///system'
+
+
+def node_uri(node):
+    """
+    Libvirt connection url of node. Should be the same as used by Node.libvirt_conn
+    """
+    return '%s+%s://%s@%s%s' % (node.driver, node.transport, node.username, node.address, node.suffix)
+
+
+class ConnectionPool(object):
+    """
+    Pool of libvirt connections shared by all agent threads in process. Connections are kept per libvirt url and handed
+    out to one task at time. Each connection is checked by isAlive before it is reused and closed if it is broken.
+    Number of connections opened to one url is limited by LIBVIRT_MAX_CONNECTIONS from agent config.
+    """
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.idle = {}
+        self.used = {}
+
+
+    def _max_connections(self):
+        return int(config.get('agent', 'LIBVIRT_MAX_CONNECTIONS', 4))
+
+
+    def _timeout(self):
+        return int(config.get('agent', 'LIBVIRT_CONNECTION_TIMEOUT', 60))
+
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            return conn.isAlive() == 1
+        except Exception:
+            return False
+
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+    def acquire(self, uri, opener=None):
+        """
+        Get connection to given url from pool. If there is no idle connection and limit of connections is not reached,
+        the new one is opened by opener (libvirt.open by default).
+        """
+        deadline = time.time() + self._timeout()
+        conn = None
+
+        self.lock.acquire()
+        try:
+            while True:
+                idle = self.idle.setdefault(uri, [])
+                if len(idle) > 0:
+                    conn = idle.pop()
+                    break
+
+                if self.used.get(uri, 0) < self._max_connections():
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TaskNotReady('libvirt_connection_limit')
+                self.lock.wait(remaining)
+
+            self.used[uri] = self.used.get(uri, 0) + 1
+        finally:
+            self.lock.release()
+
+        if conn is not None and not self._is_alive(conn):
+            log(msg='Libvirt connection to %s is broken. Reconnecting' % uri, tags=('agent', 'libvirt', 'info'))
+            self._close(conn)
+            conn = None
+
+        if conn is None:
+            try:
+                if opener is None:
+                    conn = libvirt.open(uri)
+                else:
+                    conn = opener()
+            except:
+                self._forget(uri)
+                raise
+
+        return conn
+
+
+    def release(self, uri, conn):
+        """
+        Return connection to pool. Broken connections are closed and not reused.
+        """
+        if self._is_alive(conn):
+            self.lock.acquire()
+            try:
+                self.idle.setdefault(uri, []).append(conn)
+            finally:
+                self.lock.release()
+        else:
+            self._close(conn)
+
+        self._forget(uri)
+
+
+    def _forget(self, uri):
+        self.lock.acquire()
+        try:
+            self.used[uri] = self.used.get(uri, 1) - 1
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+
+    def close_all(self, uri=None):
+        """
+        Close all idle connections (to given url or all of them)
+        """
+        self.lock.acquire()
+        try:
+            uris = [uri] if uri is not None else list(self.idle.keys())
+            connections = []
+            for u in uris:
+                connections.extend(self.idle.pop(u, []))
+        finally:
+            self.lock.release()
+
+        for conn in connections:
+            self._close(conn)
+
+
+    @contextmanager
+    def connection(self, uri, opener=None):
+        """
+        Use connection from pool in with statement. The connection is always returned to pool, also on exceptions.
+        """
+        conn = self.acquire(uri, opener)
+        try:
+            yield conn
+        finally:
+            self.release(uri, conn)
+
+
+    def local(self):
+        """
+        Connection to local libvirt (used by image and storage agents)
+        """
+        return self.connection(LOCAL_URI)
+
+
+    def node(self, node):
+        """
+        Connection to node's libvirt
+        """
+        return self.connection(node_uri(node), node.libvirt_conn)
+
+
+pool = ConnectionPool()
@@ -0,0 +1,202 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import errno
+import json
+import os
+import socket
+import threading
+import time
+
+from django.db import connection
+from corecluster.cache import Cache
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+
+
+CANCEL_KEY = 'copy_jobs:cancel'
+RUNNING_KEY = 'copy_jobs:running'
+
+# How often heartbeat of running job is called, in seconds
+HEARTBEAT_INTERVAL = 60
+
+slots_lock = threading.Lock()
+slots = None
+
+
+def _slots():
+    global slots
+    slots_lock.acquire()
+    try:
+        if slots is None:
+            slots = threading.BoundedSemaphore(int(config.get('agent', 'LIBVIRT_COPY_JOBS', 2)))
+        return slots
+    finally:
+        slots_lock.release()
+
+
+class Cancelled(Exception):
+    def __str__(self):
+        return 'copy_cancelled'
+
+
+def cancel(job_id):
+    """
+    Request cancellation of job. Works for jobs in all agent processes, because flag is kept in cache
+    """
+    Cache.hset(CANCEL_KEY, job_id, '1')
+
+
+class CopyJob(threading.Thread):
+    """
+    Long copy running in background, so agent's thread could handle next tasks. Up to LIBVIRT_COPY_JOBS (agent config)
+    jobs are copying in one process at once, the rest is waiting. Function copy is called with job as parameter and
+    should check job.cancelled when it is possible. Then finished or failed (with exception) is called. Heartbeat (if
+    given) is called every HEARTBEAT_INTERVAL seconds until job is done.
+    """
+    def __init__(self, job_id, copy, finished, failed, heartbeat=None):
+        threading.Thread.__init__(self, name='copy-%s' % job_id)
+        self.daemon = True
+        self.job_id = job_id
+        self.copy = copy
+        self.finished = finished
+        self.failed = failed
+        self.heartbeat = heartbeat
+        self.done = threading.Event()
+
+
+    def beat(self):
+        while not self.done.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                log(msg='Heartbeat of copy job %s failed' % self.job_id, exception=e, tags=('agent', 'copy', 'error'))
+
+
+    @property
+    def cancelled(self):
+        return Cache.hget(CANCEL_KEY, self.job_id) is not None
+
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+    def stop_heartbeat(self, beat):
+        """
+        Stop heartbeat before job is finished, so it doesn't refresh anything released by finished or failed
+        """
+        self.done.set()
+        if beat is not None:
+            beat.join()
+
+
+    def run(self):
+        beat = None
+        if self.heartbeat is not None:
+            beat = threading.Thread(target=self.beat, name='copy-%s-heartbeat' % self.job_id)
+            beat.daemon = True
+            beat.start()
+
+        acquired = False
+        while not self.cancelled:
+            if _slots().acquire(False):
+                acquired = True
+                break
+            time.sleep(1)
+
+        try:
+            self.check_cancelled()
+            self.copy(self)
+            self.stop_heartbeat(beat)
+            self.finished()
+        except Exception as e:
+            log(msg='Copy job %s failed' % self.job_id, exception=e, tags=('agent', 'copy', 'error'))
+            self.stop_heartbeat(beat)
+            try:
+                self.failed(e)
+            except Exception as e:
+                log(msg='Failed to cleanup after copy job %s' % self.job_id, exception=e, tags=('agent', 'copy', 'error'))
+        finally:
+            self.done.set()
+            if acquired:
+                _slots().release()
+            Cache.hdel(CANCEL_KEY, self.job_id)
+            Cache.hdel(RUNNING_KEY, self.job_id)
+            connection.close()
+
+
+def start(job_id, copy, finished, failed, info=None, heartbeat=None):
+    """
+    Start copy job. Job is registered in cache with info dictionary, so it could be cleaned up by lost() if agent
+    process is stopped before job is finished.
+    """
+    record = dict(info or {})
+    record['host'] = socket.gethostname()
+    record['pid'] = os.getpid()
+    Cache.hset(RUNNING_KEY, job_id, json.dumps(record))
+
+    job = CopyJob(job_id, copy, finished, failed, heartbeat)
+    job.start()
+    return job
+
+
+def running(job_id):
+    return Cache.hget(RUNNING_KEY, job_id) is not None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def lost():
+    """
+    Get jobs started at this host by agent processes, which don't exist anymore. Returns list of (job id, info) pairs.
+    Jobs should be removed by forget after cleanup.
+    """
+    jobs = []
+    host = socket.gethostname()
+    for job_id in Cache.hkeys(RUNNING_KEY):
+        try:
+            record = json.loads(Cache.hget(RUNNING_KEY, job_id))
+        except (TypeError, ValueError):
+            Cache.hdel(RUNNING_KEY, job_id)
+            continue
+        if record.get('host') == host and record.get('pid') != os.getpid() and not _alive(record.get('pid')):
+            jobs.append((job_id, record))
+    return jobs
+
+
+def forget(job_id):
+    Cache.hdel(RUNNING_KEY, job_id)
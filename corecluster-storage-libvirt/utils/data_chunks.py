@@ -0,0 +1,215 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import base64
+import json
+
+from corecluster.cache import Cache
+from corecluster.cache.data_chunk import DataChunk
+from corenetwork.utils import config
+from ..utils import transfer
+from ..utils.admission import Lock
+
+
+INDEX_KEY = 'upload_chunks:index'
+
+
+def _key(image):
+    return 'upload_chunks:' + str(image.id)
+
+
+def record(image, offset, length):
+    """
+    Remember that length bytes were written to image at offset
+    """
+    Cache.hset(_key(image), str(offset), str(length))
+
+
+def received(image):
+    """
+    Get list of (offset, length) pairs of written chunks, sorted by offset
+    """
+    key = _key(image)
+    chunks = []
+    for offset in Cache.hkeys(key):
+        chunks.append((int(offset), int(Cache.hget(key, offset))))
+    return sorted(chunks)
+
+
+def received_bytes(image):
+    return sum([length for offset, length in received(image)])
+
+
+def missing(image, size=None):
+    """
+    Get list of (offset, length) gaps between written chunks. If size is given, gap at the end of image is also
+    returned.
+    """
+    gaps = []
+    end = 0
+    for offset, length in received(image):
+        if offset > end:
+            gaps.append((end, offset - end))
+        end = max(end, offset + length)
+
+    if size is not None and end < size:
+        gaps.append((end, size - end))
+    return gaps
+
+
+def _index_key(image_id):
+    return 'upload_chunks:' + str(image_id) + ':waiting'
+
+
+def clear(image):
+    Cache.delete(_key(image))
+    Cache.delete(_index_key(image.id))
+
+
+def lock(image):
+    """
+    Lock used to upload chunks of one image one by one. Lock left by stopped agent expires after
+    LIBVIRT_UPLOAD_LOCK_TIMEOUT seconds.
+    """
+    return Lock('upload_chunks:' + str(image.id), 'upload_busy', int(config.get('agent', 'LIBVIRT_UPLOAD_LOCK_TIMEOUT', 600)))
+
+
+def decoded_length(encoded):
+    return len(encoded) / 4 * 3 - encoded[-2:].count('=')
+
+
+class Base64Reader(object):
+    """
+    File-like object decoding base64 string in small parts, so decoded data is never kept in memory at once
+    """
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self.pos = 0
+
+
+    def read(self, size):
+        length = max(size / 3, 1) * 4
+        data = self.encoded[self.pos:self.pos+length]
+        self.pos += len(data)
+        return base64.b64decode(data)
+
+
+    def close(self):
+        pass
+
+
+def blocks(encoded):
+    """
+    Decode base64 string into blocks of transfer.chunk_size bytes
+    """
+    reader = Base64Reader(encoded)
+    return iter(lambda: reader.read(transfer.chunk_size()), '')
+
+
+def index():
+    """
+    Add position of chunks waiting in cache, which were not seen yet, to index of their images. Each chunk is loaded
+    only once. Returns set of keys of waiting chunks.
+    """
+    keys = set(Cache.hkeys(DataChunk.container))
+    seen = set(Cache.hkeys(INDEX_KEY))
+
+    for key in keys - seen:
+        try:
+            chunk = DataChunk(cache_key=key)
+        except Exception:
+            continue
+        Cache.hset(_index_key(chunk.image_id), key, json.dumps({'id': chunk.id,
+                                                                'type': chunk.type,
+                                                                'offset': int(chunk.offset),
+                                                                'length': decoded_length(chunk.data)}))
+        Cache.hset(INDEX_KEY, key, str(chunk.image_id))
+        del chunk
+
+    # Chunks removed from cache by others
+    for key in seen - keys:
+        Cache.hdel(_index_key(Cache.hget(INDEX_KEY, key)), key)
+        Cache.hdel(INDEX_KEY, key)
+
+    return keys
+
+
+def contiguous(image, first):
+    """
+    Find chunks of image waiting in cache, which continue the first chunk without gaps. Only the image's index is
+    scanned. Returns list of (cache key, chunk, offset, length), starting with the first chunk. Chunks other than the
+    first one are loaded without data, only to be deleted. Sum of lengths is limited by LIBVIRT_COALESCE_SIZE from agent
+    config.
+    """
+    limit = int(config.get('agent', 'LIBVIRT_COALESCE_SIZE', 256*1024*1024))
+
+    keys = index()
+    waiting = {}
+    for key in Cache.hkeys(_index_key(image.id)):
+        if key == first.cache_key() or key not in keys:
+            continue
+        try:
+            entry = json.loads(Cache.hget(_index_key(image.id), key))
+        except (TypeError, ValueError):
+            continue
+        chunk = DataChunk(data=json.dumps({'id': entry['id'], 'type': entry['type']}))
+        waiting[entry['offset']] = (key, chunk, entry['offset'], entry['length'])
+
+    run = [(first.cache_key(), first, int(first.offset), decoded_length(first.data))]
+    size = run[0][3]
+    end = run[0][2] + run[0][3]
+    while end in waiting and size + waiting[end][3] <= limit:
+        run.append(waiting[end])
+        size += waiting[end][3]
+        end += waiting[end][3]
+    return run
+
+
+def read(run, first):
+    """
+    Decode data of chunks in run. Chunks (except first one, which is already loaded) are loaded from cache when they are
+    needed.
+    """
+    for key, chunk, offset, length in run:
+        if chunk is not first:
+            chunk = DataChunk(cache_key=key)
+        for data in blocks(chunk.data):
+            yield data
+        del chunk
+
+
+def delete(key, chunk):
+    """
+    Remove uploaded chunk from cache and from index
+    """
+    chunk.delete()
+    image_id = Cache.hget(INDEX_KEY, key)
+    if image_id is not None:
+        Cache.hdel(_index_key(image_id), key)
+        Cache.hdel(INDEX_KEY, key)
@@ -0,0 +1,67 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import libvirt
+
+from corecluster.models.core.vm import VM
+from corenetwork.utils.logger import log
+
+
+ACTIVE_STATES = ['running', 'starting']
+
+
+def running_domains(conn):
+    """
+    Get names of running domains by one libvirt call
+    """
+    return set([domain.name() for domain in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_RUNNING)])
+
+
+def set_vm_states(vm_ids, state):
+    """
+    Change state of VMs, which are still running or starting. VMs changed meanwhile by other agents are left untouched
+    """
+    if len(vm_ids) > 0:
+        VM.objects.filter(id__in=vm_ids, state__in=ACTIVE_STATES).update(state=state)
+
+
+def sync_vm_states(node, running, context=None):
+    """
+    Compare running and starting VMs of node with set of names of running domains and store only changed states
+    """
+    vms = node.vm_set.filter(state__in=ACTIVE_STATES).only('id', 'state')
+
+    started = [vm.id for vm in vms if vm.state != 'running' and vm.libvirt_name in running]
+    stopped = [vm.id for vm in vms if vm.libvirt_name not in running]
+
+    for vm_id in stopped:
+        log(msg='VM %s is not running at node %s' % (vm_id, node.address), tags=('agent', 'node', 'info'), context=context)
+
+    set_vm_states(started, 'running')
+    set_vm_states(stopped, 'stopped')
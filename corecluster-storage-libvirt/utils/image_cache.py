@@ -0,0 +1,279 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import libvirt
+import re
+import threading
+import time
+
+from corecluster.cache import Cache
+from corecluster.exceptions.agent import *
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+from ..utils.pool_cache import storages
+from ..utils import provisioning, transfer
+from ..utils.admission import Lock
+
+
+POOL_NAME = 'image_cache'
+LOADS_KEY = 'image_cache:loads'
+
+prefetch_lock = threading.Lock()
+prefetch_slots = None
+
+
+def enabled():
+    return bool(config.get('agent', 'LIBVIRT_IMAGE_CACHE', False))
+
+
+def budget():
+    """
+    Maximum size of cached images at one node, in bytes
+    """
+    return int(config.get('agent', 'LIBVIRT_IMAGE_CACHE_SIZE', 50*1024*1024*1024))
+
+
+def pool_xml():
+    return '''<pool type='dir'>
+  <name>%s</name>
+  <target>
+    <path>%s</path>
+  </target>
+</pool>''' % (POOL_NAME, config.get('agent', 'LIBVIRT_IMAGE_CACHE_PATH', '/var/lib/cloudOver/image_cache'))
+
+
+def _usage_key(node):
+    return 'image_cache:' + str(node.id)
+
+
+def touch(node, image_id):
+    Cache.hset(_usage_key(node), image_id, str(time.time()))
+
+
+def forget(node, image_id):
+    Cache.hdel(_usage_key(node), image_id)
+    Cache.hdel(_versions_key(node), image_id)
+
+
+def _versions_key(node):
+    return 'image_cache:' + str(node.id) + ':versions'
+
+
+def version(image, base_volume):
+    """
+    Identify content of image's base volume by its size, sha256 and modification time, so image uploaded again with
+    the same size is not taken from cache
+    """
+    xml = base_volume.XMLDesc(0)
+    mtime = re.findall(r'<mtime>([^<]+)</mtime>', xml)
+    return '%d %s %s' % (base_volume.info()[1], image.get_prop('sha256'), mtime[0] if len(mtime) > 0 else None)
+
+
+def last_used(node, image_id):
+    try:
+        return float(Cache.hget(_usage_key(node), image_id))
+    except (TypeError, ValueError):
+        return 0
+
+
+def prefetch_rate():
+    """
+    Bandwidth of prefetching images to one node, in bytes per second. It is shared by operations at the node. 0 means
+    no limit
+    """
+    return int(config.get('agent', 'LIBVIRT_PREFETCH_RATE', 0))
+
+
+def prefetch_jobs():
+    """
+    Semaphore limiting number of images prefetched at once by one agent process
+    """
+    global prefetch_slots
+    prefetch_lock.acquire()
+    try:
+        if prefetch_slots is None:
+            prefetch_slots = threading.BoundedSemaphore(int(config.get('agent', 'LIBVIRT_PREFETCH_JOBS', 2)))
+        return prefetch_slots
+    finally:
+        prefetch_lock.release()
+
+
+def record_load(image_id):
+    """
+    Count loads of image in current window of LIBVIRT_AUTO_PREFETCH_WINDOW seconds
+    """
+    now = time.time()
+    start = now
+    count = 0
+    try:
+        s, c = Cache.hget(LOADS_KEY, image_id).split()
+        if now - float(s) < int(config.get('agent', 'LIBVIRT_AUTO_PREFETCH_WINDOW', 3600)):
+            start = float(s)
+            count = int(c)
+    except (AttributeError, ValueError):
+        pass
+    Cache.hset(LOADS_KEY, image_id, '%f %d' % (start, count + 1))
+
+
+def popular():
+    """
+    Get ids of images loaded at least LIBVIRT_AUTO_PREFETCH_LOADS times in current window
+    """
+    threshold = int(config.get('agent', 'LIBVIRT_AUTO_PREFETCH_LOADS', 5))
+    ids = []
+    for image_id in Cache.hkeys(LOADS_KEY):
+        try:
+            s, c = Cache.hget(LOADS_KEY, image_id).split()
+        except (AttributeError, ValueError):
+            continue
+        if int(c) >= threshold:
+            ids.append(image_id)
+    return ids
+
+
+def forget_loads(image_id):
+    Cache.hdel(LOADS_KEY, image_id)
+
+
+def get_pool(conn):
+    """
+    Get node's cache pool. The pool is defined and started if it doesn't exist
+    """
+    try:
+        storage = storages.get(conn, POOL_NAME)
+    except libvirt.libvirtError:
+        log(msg='Defining image cache pool', tags=('agent', 'node', 'info'))
+        pool = conn.storagePoolDefineXML(pool_xml(), 0)
+        pool.setAutostart(True)
+        pool.build(0)
+        storages.invalidate(conn, POOL_NAME)
+        storage = storages.get(conn, POOL_NAME)
+
+    if not storage.running:
+        storage.create(0)
+    return storage
+
+
+def backing_paths(conn):
+    """
+    Get set of paths used as backing files by volumes in node's images pool
+    """
+    paths = set()
+    images = storages.get(conn, 'images')
+    for volume in images.listAllVolumes(0):
+        try:
+            xml = volume.XMLDesc(0)
+        except libvirt.libvirtError:
+            continue
+        for backing in re.findall(r'<backingStore>.*?</backingStore>', xml, re.S):
+            paths.update(re.findall(r'<path>([^<]+)</path>', backing))
+    return paths
+
+
+def evict(conn, node, cache_pool, needed):
+    """
+    Remove least recently used images from cache until needed bytes fit into budget. Images used as backing files by
+    VM volumes are never removed.
+    """
+    volumes = []
+    for volume in cache_pool.listAllVolumes(0):
+        volumes.append((last_used(node, volume.name()), volume.info()[2], volume))
+
+    used = sum([v[1] for v in volumes])
+    if used + needed <= budget():
+        return
+
+    in_use = backing_paths(conn)
+    for last, size, volume in sorted(volumes, key=lambda v: v[0]):
+        if used + needed <= budget():
+            break
+        if volume.path() in in_use:
+            continue
+
+        log(msg='Evicting image %s from cache of node %s' % (volume.name(), node.id), tags=('agent', 'node', 'info'))
+        try:
+            volume.delete(0)
+            forget(node, volume.name())
+            used -= size
+        except libvirt.libvirtError as e:
+            log(msg='Failed to evict cached image', exception=e, tags=('agent', 'node', 'error'))
+
+    if used + needed > budget():
+        log(msg='Image cache of node %s is over budget' % node.id, tags=('agent', 'node', 'alert'))
+
+
+def fetch(conn, node, image, base_volume, throttle=None):
+    """
+    Get local copy of image at node. Image is copied from base_volume if it is not cached yet or if cached copy is
+    outdated. Outdated copy used as backing file by VMs is not removed and base_volume is returned instead. If throttle
+    is given, copy is done by libvirt streams and data is passed through it.
+    """
+    with Lock('image_cache:' + str(node.id) + ':' + str(image.id), 'node_image_cache_busy'):
+        cache_pool = get_pool(conn)
+        current = version(image, base_volume)
+
+        try:
+            volume = cache_pool.storageVolLookupByName(str(image.id))
+        except libvirt.libvirtError:
+            volume = None
+
+        if volume is not None:
+            if Cache.hget(_versions_key(node), str(image.id)) == current:
+                touch(node, image.id)
+                return volume
+
+            if volume.path() in backing_paths(conn):
+                log(msg='Cached image %s is outdated, but it is used by VMs. Using base volume' % image.id, tags=('agent', 'node', 'info'))
+                return base_volume
+
+            log(msg='Cached image %s is outdated' % image.id, tags=('agent', 'node', 'info'))
+            try:
+                volume.delete(0)
+            except libvirt.libvirtError as e:
+                raise TaskError('node_image_cache_failed', exception=e)
+            forget(node, image.id)
+
+        evict(conn, node, cache_pool, base_volume.info()[2])
+
+        try:
+            if throttle is not None:
+                volume = cache_pool.createXML(provisioning.clone_xml(base_volume, str(image.id)), 0)
+                try:
+                    transfer.upload(conn, volume, throttle(transfer.download(conn, base_volume)), sparse=True)
+                except:
+                    volume.delete(0)
+                    raise
+            else:
+                volume = cache_pool.createXMLFrom(provisioning.clone_xml(base_volume, str(image.id)), base_volume, 0)
+        except libvirt.libvirtError as e:
+            raise TaskError('node_image_cache_failed', exception=e)
+
+        Cache.hset(_versions_key(node), str(image.id), current)
+        touch(node, image.id)
+        return volume
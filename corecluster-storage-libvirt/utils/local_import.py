@@ -0,0 +1,87 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+
+import os
+import urllib
+import urlparse
+
+from corenetwork.utils import config, system
+
+
+def directories():
+    """
+    Get list of directories, from which images could be imported directly (LIBVIRT_LOCAL_IMPORT_PATHS in agent config)
+    """
+    return [os.path.realpath(d) for d in config.get('agent', 'LIBVIRT_LOCAL_IMPORT_PATHS', [])]
+
+
+def source_path(url):
+    """
+    Get local path of file given by file:// url or absolute path, if it could be imported directly. Returns None for
+    remote urls and for files outside of allowed directories.
+    """
+    if url.startswith('file://'):
+        path = urllib.url2pathname(urlparse.urlparse(url).path)
+    elif url.startswith('/'):
+        path = url
+    else:
+        return None
+
+    path = os.path.realpath(path)
+    if not os.path.isfile(path):
+        return None
+
+    for directory in directories():
+        if path.startswith(directory.rstrip('/') + '/'):
+            return path
+    return None
+
+
+def remote(url):
+    """
+    Check if url is downloaded by network. Other urls (local paths, file://) could be used only by source_path.
+    """
+    return urlparse.urlparse(url).scheme.lower() in ['http', 'https', 'ftp']
+
+
+def copy(path, volume, sparse=False):
+    """
+    Copy file into volume's file by cp. Reflink is made if both files are on the same filesystem supporting it,
+    otherwise data is copied by the kernel (copy_file_range), without reading it by the agent. Returns False if cp
+    failed.
+    """
+    r = system.call(['sudo',
+                     'cp',
+                     '--reflink=auto',
+                     '--sparse=always' if sparse else '--sparse=auto',
+                     path,
+                     volume.path()], stderr=None, stdout=None)
+    return r == 0
@@ -0,0 +1,188 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import libvirt
+import threading
+import time
+import weakref
+
+from corenetwork.utils import config
+
+
+class PoolState(object):
+    """
+    State of one storage pool at one libvirt host. It is shared by all connections to this host, so concurrent refreshes
+    of the same pool are merged into one.
+    """
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.refreshing = False
+        self.generation = 0
+        self.refreshed = 0
+        self.running = None
+        self.state_checked = 0
+
+
+class CachedStoragePool(object):
+    """
+    Wrapper for libvirt's storage pool handle. All calls not defined here are passed to the handle. Refresh is merged
+    with other refreshes of this pool which are in progress and volume lookups refresh pool only when volume is
+    not found.
+    """
+    def __init__(self, handle, state, interval):
+        self.handle = handle
+        self.state = state
+        self.interval = interval
+
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+
+    @property
+    def running(self):
+        """
+        Check if pool is running. Positive result is kept for refresh interval
+        """
+        s = self.state
+        if s.running and time.time() - s.state_checked < self.interval:
+            return True
+
+        s.running = self.handle.info()[0] == libvirt.VIR_STORAGE_POOL_RUNNING
+        s.state_checked = time.time()
+        return s.running
+
+
+    def refresh(self, flags=0):
+        """
+        Refresh pool. If other thread is refreshing this pool now, wait for its result instead of starting next scan
+        """
+        s = self.state
+        s.lock.acquire()
+        try:
+            if s.refreshing:
+                generation = s.generation
+                while s.refreshing and s.generation == generation:
+                    s.lock.wait()
+                return
+            s.refreshing = True
+        finally:
+            s.lock.release()
+
+        try:
+            self.handle.refresh(flags)
+        finally:
+            s.lock.acquire()
+            s.refreshing = False
+            s.generation += 1
+            s.refreshed = time.time()
+            s.lock.notify_all()
+            s.lock.release()
+
+
+    def refresh_if_stale(self):
+        if time.time() - self.state.refreshed >= self.interval:
+            self.refresh(0)
+
+
+    def storageVolLookupByName(self, name):
+        try:
+            return self.handle.storageVolLookupByName(name)
+        except libvirt.libvirtError:
+            self.refresh(0)
+            return self.handle.storageVolLookupByName(name)
+
+
+class StoragePoolCache(object):
+    """
+    Cache of storage pool handles kept for each libvirt connection. Pools are refreshed only when volume is not found
+    or after LIBVIRT_POOL_REFRESH_INTERVAL seconds (agent config) since last refresh.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handles = weakref.WeakKeyDictionary()
+        self.states = {}
+
+
+    def _interval(self):
+        return int(config.get('agent', 'LIBVIRT_POOL_REFRESH_INTERVAL', 60))
+
+
+    def _connection_cache(self, conn):
+        self.lock.acquire()
+        try:
+            cache = self.handles.get(conn)
+        finally:
+            self.lock.release()
+
+        if cache is None:
+            cache = {'uri': conn.getURI(), 'pools': {}}
+            self.lock.acquire()
+            try:
+                self.handles[conn] = cache
+            finally:
+                self.lock.release()
+        return cache
+
+
+    def get(self, conn, name):
+        """
+        Get cached storage pool by name. Raises libvirt's exception if pool does not exist.
+        """
+        cache = self._connection_cache(conn)
+        handle = cache['pools'].get(name)
+        if handle is None:
+            handle = conn.storagePoolLookupByName(name)
+            cache['pools'][name] = handle
+
+        self.lock.acquire()
+        try:
+            state = self.states.setdefault((cache['uri'], name), PoolState())
+        finally:
+            self.lock.release()
+
+        return CachedStoragePool(handle, state, self._interval())
+
+
+    def invalidate(self, conn, name):
+        """
+        Forget all handles and state of pool at the host of given connection. Call it when pool is (re)defined.
+        """
+        uri = self._connection_cache(conn)['uri']
+        self.lock.acquire()
+        try:
+            self.states.pop((uri, name), None)
+            for cache in self.handles.values():
+                if cache['uri'] == uri:
+                    cache['pools'].pop(name, None)
+        finally:
+            self.lock.release()
+
+
+storages = StoragePoolCache()
@@ -0,0 +1,122 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+
+
+class ProgressReporter(object):
+    """
+    Store progress of long operations in 'progress' property of model (Image or VM). Model is loaded once, only its
+    additional data is saved and writes are limited: progress is stored if it changed by PROGRESS_STEP or if
+    PROGRESS_INTERVAL seconds passed since last write (both from agent config). Call finish to always store the final
+    value.
+    """
+    def __init__(self, obj, total):
+        self.obj = obj
+        self.total = total
+        self.interval = float(config.get('agent', 'PROGRESS_INTERVAL', 5))
+        self.step = float(config.get('agent', 'PROGRESS_STEP', 0.01))
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.written = None
+        self.written_at = 0
+
+
+    def update(self, done):
+        if not self.total:
+            return
+
+        self.lock.acquire()
+        try:
+            self.value = min(float(done)/float(self.total), 1.0)
+            if self.written is None \
+                    or self.value - self.written >= self.step \
+                    or (self.value != self.written and time.time() - self.written_at >= self.interval):
+                self._write()
+        finally:
+            self.lock.release()
+
+
+    def finish(self, done=None):
+        """
+        Store last progress regardless of limits
+        """
+        if not self.total:
+            return
+
+        self.lock.acquire()
+        try:
+            if done is not None:
+                self.value = min(float(done)/float(self.total), 1.0)
+            self._write()
+        finally:
+            self.lock.release()
+
+
+    def _write(self):
+        self.obj.set_prop('progress', self.value)
+        self.obj.save(update_fields=['_data'])
+        self.written = self.value
+        self.written_at = time.time()
+
+
+@contextmanager
+def watch(reporter, poll, interval=None):
+    """
+    Report progress of blocking libvirt operation (e.g. createXMLFrom). Poll function is called periodically in background
+    thread until with block is finished and should return number of bytes done.
+    """
+    stopped = threading.Event()
+    if interval is None:
+        interval = reporter.interval
+
+    def run():
+        try:
+            while not stopped.wait(interval):
+                try:
+                    reporter.update(poll())
+                except Exception as e:
+                    log(msg='Failed to check progress', exception=e, tags=('agent', 'progress', 'debug'))
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield reporter
+    finally:
+        stopped.set()
+        thread.join()
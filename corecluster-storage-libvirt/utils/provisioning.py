@@ -0,0 +1,153 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import libvirt
+import re
+
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+from ..utils import transfer
+
+
+MODES = ['copy', 'reflink', 'overlay']
+
+
+def mode(task):
+    """
+    Get provisioning mode of new volumes from 'provisioning' task property or LIBVIRT_PROVISIONING in agent config:
+    - copy: full copy of base volume
+    - reflink: copy-on-write clone of base volume. Works only on filesystems with reflinks (btrfs, xfs) if both volumes
+      are at the same filesystem. Full copy is made if clone fails.
+    - overlay: qcow2 volume backed by base volume
+    """
+    m = task.get_prop('provisioning', config.get('agent', 'LIBVIRT_PROVISIONING', 'copy'))
+    if m not in MODES:
+        log(msg='Unknown provisioning mode %s. Using copy' % m, tags=('agent', 'provisioning', 'alert'), context=task.logger_ctx)
+        return 'copy'
+    return m
+
+
+def volume_xml(base_volume, mode='copy', base_format='qcow2'):
+    """
+    Prepare xml of new volume created from base_volume in given mode. Name of volume should be set by rename_xml
+    """
+    if mode == 'overlay':
+        return '''<volume>
+  <name></name>
+  <capacity>%(capacity)d</capacity>
+  <target>
+    <format type='qcow2'/>
+  </target>
+  <backingStore>
+    <path>%(path)s</path>
+    <format type='%(format)s'/>
+  </backingStore>
+</volume>''' % {'capacity': base_volume.info()[1],
+                'path': base_volume.path(),
+                'format': base_format}
+
+    xml = base_volume.XMLDesc(0)
+    xml = re.sub(r'<key>[^<]*</key>', '', xml)
+    xml = re.sub(r'<group>[0-9\.]+</group>', '', xml)
+    xml = re.sub(r'<owner>[0-9\.]+</owner>', '', xml)
+    return xml
+
+
+def rename_xml(xml, name):
+    return re.sub(r'<name>[^<]*</name>', '<name>%s</name>' % name, xml, count=1)
+
+
+def clone_xml(base_volume, name):
+    """
+    Prepare xml of new volume, based on definition of base_volume
+    """
+    return rename_xml(volume_xml(base_volume), name)
+
+
+def clone(storage, base_volume, name, mode='copy', base_format='qcow2', xml=None):
+    """
+    Create new volume called name in storage from base_volume. Returns new volume. Xml prepared by volume_xml could be
+    given to avoid asking libvirt for base volume's definition again.
+    """
+    if xml is None:
+        xml = volume_xml(base_volume, mode, base_format)
+    xml = rename_xml(xml, name)
+
+    if mode == 'overlay':
+        return storage.createXML(xml, 0)
+
+    if mode == 'reflink' and hasattr(libvirt, 'VIR_STORAGE_VOL_CREATE_REFLINK'):
+        try:
+            return storage.createXMLFrom(xml, base_volume, libvirt.VIR_STORAGE_VOL_CREATE_REFLINK)
+        except libvirt.libvirtError as e:
+            log(msg='Reflink clone of %s failed. Copying' % base_volume.name(), exception=e, tags=('agent', 'provisioning', 'info'))
+
+    return storage.createXMLFrom(xml, base_volume, 0)
+
+
+def backing_path(volume):
+    """
+    Get path of volume's backing file or None if volume has no backing file
+    """
+    backing = re.search(r'<backingStore>.*?</backingStore>', volume.XMLDesc(0), re.S)
+    if backing is None:
+        return None
+    path = re.search(r'<path>([^<]+)</path>', backing.group(0))
+    if path is None:
+        return None
+    return path.group(1)
+
+
+def backed_by(storage, volume):
+    """
+    Get names of volumes in storage, which use volume as backing file
+    """
+    path = volume.path()
+    names = []
+    for v in storage.listAllVolumes(0):
+        try:
+            if backing_path(v) == path:
+                names.append(v.name())
+        except libvirt.libvirtError:
+            continue
+    return names
+
+
+def copy_overlay(conn, storage, overlay, name, base_volume, progress=None):
+    """
+    Copy qcow2 overlay over base_volume into new volume called name in storage. Backing file is kept, so only clusters
+    stored in overlay are copied. New volume is removed if copy fails.
+    """
+    volume = clone(storage, base_volume, name, 'overlay')
+    try:
+        transfer.upload(conn, volume, transfer.download(conn, overlay), progress=progress)
+    except:
+        volume.delete(0)
+        raise
+    return volume
@@ -0,0 +1,225 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import Queue
+import threading
+import urllib2
+
+from django.db import connection
+from corecluster.cache import Cache
+from corecluster.exceptions.agent import *
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+from ..utils import transfer, compression
+
+
+COMPRESSED_TYPES = ['application/gzip', 'application/x-gzip', 'application/x-xz', 'application/zstd']
+
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+def supported(url, size):
+    """
+    Check if url could be downloaded in ranges. Server should accept byte ranges, file should have at least size bytes
+    and it shouldn't be compressed. Ranged downloads are disabled if LIBVIRT_RANGE_CONNECTIONS is lower than 2.
+    """
+    if int(config.get('agent', 'LIBVIRT_RANGE_CONNECTIONS', 4)) < 2:
+        return False
+
+    if not url.startswith('http://') and not url.startswith('https://'):
+        return False
+
+    try:
+        response = urllib2.urlopen(HeadRequest(url))
+        accept_ranges = response.info().getheader('Accept-Ranges', '')
+        length = int(response.info().getheader('Content-Length', '0'))
+        content_type = response.info().getheader('Content-Type', '')
+        response.close()
+    except Exception as e:
+        log(msg='Cannot check ranges support of %s' % url, exception=e, tags=('agent', 'image', 'info'))
+        return False
+
+    # Compressed images are decompressed as one stream
+    if content_type.split(';')[0].strip() in COMPRESSED_TYPES:
+        return False
+
+    if accept_ranges.strip().lower() != 'bytes' or length < size:
+        return False
+
+    # Servers often don't mark compressed files by content type, so first bytes are checked too
+    try:
+        response = urllib2.urlopen(urllib2.Request(url, headers={'Range': 'bytes=0-15'}))
+        head = response.read(16)
+        response.close()
+    except Exception as e:
+        log(msg='Cannot read first bytes of %s' % url, exception=e, tags=('agent', 'image', 'info'))
+        return False
+
+    return compression.from_magic(head) is None
+
+
+def _chunks(response, length):
+    size = transfer.chunk_size()
+    bytes = 0
+    while bytes < length:
+        data = response.read(min(size, length - bytes))
+        if len(data) == 0:
+            raise IOError('range_incomplete')
+        bytes += len(data)
+        yield data
+
+
+class RangedDownload(object):
+    """
+    Download url in ranges over LIBVIRT_RANGE_CONNECTIONS parallel connections (agent config). Each range is passed
+    to write function with its offset and length and is retried up to LIBVIRT_RANGE_RETRIES times. Finished ranges are
+    remembered in cache under given key, so interrupted download could be resumed by next download of the same url.
+    """
+    def __init__(self, url, size, key):
+        self.url = url
+        self.size = size
+        self.key = key
+        self.range_size = int(config.get('agent', 'LIBVIRT_RANGE_SIZE', 64*1024*1024))
+        self.connections = int(config.get('agent', 'LIBVIRT_RANGE_CONNECTIONS', 4))
+        self.retries = int(config.get('agent', 'LIBVIRT_RANGE_RETRIES', 3))
+        self.lock = threading.Lock()
+        self.bytes = 0
+
+
+    def ranges(self):
+        offset = 0
+        index = 0
+        while offset < self.size:
+            yield index, offset, min(self.range_size, self.size - offset)
+            offset += self.range_size
+            index += 1
+
+
+    def pending(self):
+        """
+        Get ranges which are not downloaded yet
+        """
+        signature = '%s:%d:%d' % (self.url, self.size, self.range_size)
+        if Cache.hget(self.key, 'signature') != signature:
+            self.clear()
+            Cache.hset(self.key, 'signature', signature)
+
+        done = Cache.hkeys(self.key)
+        pending = []
+        for index, offset, length in self.ranges():
+            if str(index) in done:
+                self.bytes += length
+            else:
+                pending.append((index, offset, length))
+        return pending
+
+
+    def clear(self):
+        Cache.delete(self.key)
+
+
+    def fetch(self, index, offset, length, write, progress):
+        request = urllib2.Request(self.url, headers={'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+        response = urllib2.urlopen(request)
+        try:
+            if response.getcode() != 206:
+                raise IOError('range_not_supported')
+
+            sent = [0]
+
+            def range_progress(bytes):
+                self.lock.acquire()
+                try:
+                    self.bytes += bytes - sent[0]
+                    sent[0] = bytes
+                    total = self.bytes
+                finally:
+                    self.lock.release()
+                if progress is not None:
+                    progress(total)
+
+            try:
+                write(offset, length, _chunks(response, length), range_progress)
+            except:
+                range_progress(0)
+                raise
+        finally:
+            response.close()
+
+        Cache.hset(self.key, str(index), '1')
+
+
+    def run(self, write, progress=None):
+        """
+        Download all pending ranges. Function write(offset, length, chunks, progress) should store data of range.
+        """
+        queue = Queue.Queue()
+        for r in self.pending():
+            queue.put(r)
+
+        failed = []
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        index, offset, length = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+
+                    for attempt in range(self.retries + 1):
+                        try:
+                            self.fetch(index, offset, length, write, progress)
+                            break
+                        except Exception as e:
+                            log(msg='Download of range %d of %s failed (attempt %d)' % (index, self.url, attempt + 1),
+                                exception=e,
+                                tags=('agent', 'image', 'alert'))
+                    else:
+                        failed.append(index)
+            finally:
+                connection.close()
+
+        workers = []
+        for i in range(min(self.connections, queue.qsize())):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            workers.append(thread)
+
+        for thread in workers:
+            thread.join()
+
+        if len(failed) > 0:
+            raise TaskError('url_ranges_failed')
+
+        self.clear()
+        return self.bytes
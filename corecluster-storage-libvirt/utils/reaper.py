@@ -0,0 +1,195 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+
+import libvirt
+import re
+import time
+
+from corecluster.cache import Cache
+from corecluster.models.core.image import Image
+from corecluster.models.core.node import Node
+from corecluster.models.core.storage import Storage
+from corecluster.models.core.vm import VM
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+from ..utils.connection_pool import pool
+from ..utils.pool_cache import storages
+from ..utils import provisioning
+
+
+QUEUE_KEY = 'volume_reaper'
+ORPHANS_KEY = 'volume_reaper:orphans'
+
+
+def _entry(node_id, pool_name, name):
+    return '%s|%s|%s' % (node_id or '', pool_name, name)
+
+
+def schedule(node, pool_name, name):
+    """
+    Queue volume for removal by reaper agent. Node is None for volumes in local libvirt (image storages)
+    """
+    Cache.hset(QUEUE_KEY, _entry(node.id if node is not None else None, pool_name, name), str(time.time()))
+
+
+def pending():
+    """
+    Get queued volumes grouped by pool: {(node id, pool name): [volume names]}. Node id is empty for local pools
+    """
+    batches = {}
+    for entry in Cache.hkeys(QUEUE_KEY):
+        try:
+            node_id, pool_name, name = entry.split('|', 2)
+        except ValueError:
+            Cache.hdel(QUEUE_KEY, entry)
+            continue
+        batches.setdefault((node_id, pool_name), []).append(name)
+    return batches
+
+
+def _connection(node_id):
+    if node_id == '':
+        return pool.local()
+    return pool.node(Node.objects.get(pk=node_id))
+
+
+def reap():
+    """
+    Remove queued volumes. Volumes are removed pool by pool, so each pool is looked up and refreshed once for whole
+    batch. Volumes which cannot be removed now (e.g. node is offline) are kept in queue. Returns number of removed
+    volumes.
+    """
+    removed = 0
+    for (node_id, pool_name), names in pending().items():
+        try:
+            with _connection(node_id) as conn:
+                storage = storages.get(conn, pool_name)
+                storage.refresh(0)
+
+                for name in names:
+                    try:
+                        volume = storage.handle.storageVolLookupByName(name)
+                    except libvirt.libvirtError:
+                        Cache.hdel(QUEUE_KEY, _entry(node_id, pool_name, name))
+                        continue
+
+                    try:
+                        volume.delete(0)
+                        removed += 1
+                        Cache.hdel(QUEUE_KEY, _entry(node_id, pool_name, name))
+                    except libvirt.libvirtError as e:
+                        log(msg='Cannot remove volume %s from pool %s' % (name, pool_name), exception=e, tags=('agent', 'reaper', 'error'))
+        except Node.DoesNotExist:
+            for name in names:
+                Cache.hdel(QUEUE_KEY, _entry(node_id, pool_name, name))
+        except Exception as e:
+            log(msg='Cannot reap volumes of pool %s at %s' % (pool_name, node_id or 'management'), exception=e, tags=('agent', 'reaper', 'error'))
+    return removed
+
+
+def _image_orphan(name):
+    # Volumes of images are called <user id>_<image id>
+    m = re.match(r'^[^_]+_(.+)$', name)
+    if m is None:
+        return False
+    return not Image.objects.filter(pk=m.group(1)).exclude(state='deleted').exists()
+
+
+def _vm_orphan(node, name):
+    # Volumes of vms are called by vm id
+    return not VM.objects.filter(pk=name, node=node).exclude(state='closed').exists()
+
+
+def _orphans(storage, is_orphan):
+    """
+    Get names of volumes in pool, which have no record in database. Volumes used as backing files are never orphans.
+    """
+    volumes = storage.listAllVolumes(0)
+    backing = set([provisioning.backing_path(v) for v in volumes])
+    names = []
+    for volume in volumes:
+        try:
+            if is_orphan(volume.name()) and volume.path() not in backing:
+                names.append(volume.name())
+        except Exception as e:
+            log(msg='Cannot check volume %s' % volume.name(), exception=e, tags=('agent', 'reaper', 'debug'))
+    return names
+
+
+def sweep():
+    """
+    Find volumes without matching Image or VM record in image storages and nodes' images pools. Volume is queued for
+    removal if it is found orphaned again after LIBVIRT_ORPHAN_GRACE seconds, so volumes of objects being created now
+    are not removed.
+    """
+    found = []
+
+    with pool.local() as conn:
+        for s in Storage.objects.filter(state='ok'):
+            try:
+                storage = storages.get(conn, s.name)
+                storage.refresh(0)
+                found += [('', s.name, name) for name in _orphans(storage, _image_orphan)]
+            except Exception as e:
+                log(msg='Cannot sweep storage %s' % s.name, exception=e, tags=('agent', 'reaper', 'error'))
+
+    for node in Node.objects.filter(state='ok'):
+        try:
+            with pool.node(node) as conn:
+                storage = storages.get(conn, 'images')
+                storage.refresh(0)
+                found += [(node.id, 'images', name) for name in _orphans(storage, lambda name: _vm_orphan(node, name))]
+        except Exception as e:
+            log(msg='Cannot sweep node %s' % node.id, exception=e, tags=('agent', 'reaper', 'error'))
+
+    grace = int(config.get('agent', 'LIBVIRT_ORPHAN_GRACE', 3600))
+    now = time.time()
+    queued = set(Cache.hkeys(QUEUE_KEY))
+    orphans = set()
+    for node_id, pool_name, name in found:
+        entry = _entry(node_id, pool_name, name)
+        orphans.add(entry)
+        if entry in queued:
+            continue
+
+        try:
+            seen = float(Cache.hget(ORPHANS_KEY, entry))
+        except (TypeError, ValueError):
+            Cache.hset(ORPHANS_KEY, entry, str(now))
+            continue
+
+        if now - seen > grace:
+            log(msg='Removing orphaned volume %s from pool %s at %s' % (name, pool_name, node_id or 'management'), tags=('agent', 'reaper', 'info'))
+            Cache.hset(QUEUE_KEY, entry, str(now))
+
+    for entry in Cache.hkeys(ORPHANS_KEY):
+        if entry not in orphans or entry in queued:
+            Cache.hdel(ORPHANS_KEY, entry)
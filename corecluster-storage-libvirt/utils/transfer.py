@@ -0,0 +1,314 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import Queue
+import libvirt
+import re
+import threading
+
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+
+
+def chunk_size():
+    return int(config.get('agent', 'LIBVIRT_TRANSFER_CHUNK_SIZE', 4*1024*1024))
+
+
+def queue_size():
+    return int(config.get('agent', 'LIBVIRT_TRANSFER_QUEUE_SIZE', 8))
+
+
+def sparse_enabled(task):
+    """
+    Check if task should skip zero blocks. Could be set by 'sparse' task property or LIBVIRT_SPARSE_UPLOAD in agent config
+    """
+    return bool(task.get_prop('sparse', config.get('agent', 'LIBVIRT_SPARSE_UPLOAD', False)))
+
+
+def sparse_block_size():
+    return int(config.get('agent', 'LIBVIRT_SPARSE_BLOCK_SIZE', 64*1024))
+
+
+class ReadAhead(object):
+    """
+    Read data from file-like source in background thread and keep up to queue_size chunks in memory. Iterate over this
+    object to get chunks. Reading stops at the end of source or after size bytes (if given). Exceptions raised by
+    source are raised again in iterating thread.
+    """
+    _end = object()
+
+    def __init__(self, source, size=None, chunk=None, depth=None):
+        self.source = source
+        self.size = size
+        self.chunk = chunk or chunk_size()
+        self.queue = Queue.Queue(depth or queue_size())
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+
+    def _read(self):
+        bytes = 0
+        try:
+            while self.size is None or bytes < self.size:
+                length = self.chunk
+                if self.size is not None:
+                    length = min(length, self.size - bytes)
+                data = self.source.read(length)
+                if len(data) == 0:
+                    break
+                bytes += len(data)
+                if not self._put(data):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._end)
+
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is self._end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+    def close(self):
+        """
+        Stop reading thread. Call it always when iteration is finished or interrupted.
+        """
+        self.stopped.set()
+        self.thread.join()
+
+
+def send(stream, data):
+    """
+    Send whole buffer to libvirt stream
+    """
+    sent = 0
+    while sent < len(data):
+        sent += stream.send(data[sent:] if sent > 0 else data)
+
+
+def regions(chunks, block=None):
+    """
+    Split chunks into data and zero regions. Yields pairs (data, length), where data is None for regions containing
+    only zeros. Neighbouring regions of the same kind are merged within one chunk and zero regions also between chunks.
+    """
+    block = block or sparse_block_size()
+    zero = '\0' * block
+    hole = 0
+
+    for data in chunks:
+        start = 0
+        pos = 0
+        while pos < len(data):
+            piece = data[pos:pos+block]
+            if piece == zero[:len(piece)]:
+                if pos > start:
+                    yield data[start:pos], pos - start
+                hole += len(piece)
+                start = pos + len(piece)
+            elif hole > 0:
+                yield None, hole
+                hole = 0
+            pos += len(piece)
+
+        if start < len(data):
+            yield data[start:], len(data) - start
+
+    if hole > 0:
+        yield None, hole
+
+
+def download(conn, volume, offset=0, length=0):
+    """
+    Read volume's content (or length bytes starting at offset) through libvirt stream. Yields blocks of chunk_size
+    bytes.
+    """
+    stream = conn.newStream(0)
+    volume.download(stream, offset, length, 0)
+    try:
+        while True:
+            data = stream.recv(chunk_size())
+            if len(data) == 0:
+                break
+            yield data
+    except BaseException:
+        _abort(stream)
+        raise
+    _finish(stream)
+
+
+def _finish(stream):
+    try:
+        stream.finish()
+    except:
+        _abort(stream)
+        raise
+
+
+def _abort(stream):
+    try:
+        stream.abort()
+    except Exception:
+        pass
+
+
+def _upload_sparse_stream(conn, volume, chunks, offset, length, progress):
+    stream = conn.newStream(0)
+    try:
+        volume.upload(stream, offset, length, libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+    except libvirt.libvirtError as e:
+        _abort(stream)
+        log(msg='Sparse streams are not supported by storage driver', exception=e, tags=('agent', 'image', 'info'))
+        return None
+
+    bytes = 0
+    try:
+        for data, size in regions(chunks):
+            if data is None:
+                stream.sendHole(size, 0)
+            else:
+                send(stream, data)
+            bytes += size
+            if progress is not None:
+                progress(bytes)
+    except:
+        _abort(stream)
+        raise
+
+    _finish(stream)
+    return bytes
+
+
+def _empty_raw(volume):
+    """
+    Check if volume is raw and has no data allocated (e.g. it was just created), so regions which are not written read
+    as zeros. Qcow2 volumes always contain metadata written by libvirt.
+    """
+    try:
+        return volume.info()[2] == 0 and re.search(r"<format type=['\"]raw['\"]", volume.XMLDesc(0)) is not None
+    except libvirt.libvirtError:
+        return False
+
+
+def _upload_skip_zeros(conn, volume, chunks, offset, progress):
+    """
+    Upload data regions by separate streams and skip zero regions. Volume should be empty raw volume (see _empty_raw), because
+    skipped regions are not overwritten. Last byte of trailing zero region is written to keep size of volume.
+    """
+    stream = None
+    bytes = 0
+    try:
+        for data, size in regions(chunks):
+            if data is None:
+                if stream is not None:
+                    _finish(stream)
+                    stream = None
+            else:
+                if stream is None:
+                    stream = conn.newStream(0)
+                    volume.upload(stream, offset + bytes, 0, 0)
+                send(stream, data)
+            bytes += size
+            if progress is not None:
+                progress(bytes)
+
+        if stream is not None:
+            _finish(stream)
+            stream = None
+        elif bytes > 0:
+            stream = conn.newStream(0)
+            volume.upload(stream, offset + bytes - 1, 1, 0)
+            send(stream, '\0')
+            _finish(stream)
+            stream = None
+    except:
+        if stream is not None:
+            _abort(stream)
+        raise
+
+    return bytes
+
+
+def upload(conn, volume, chunks, offset=0, length=0, progress=None, sparse=False):
+    """
+    Upload chunks to volume starting at offset by one libvirt stream. Progress function is called with number of bytes
+    sent after each chunk. Returns number of bytes sent.
+
+    If sparse is set, blocks containing only zeros are sent as holes by sparse stream. If libvirt or storage driver
+    doesn't support sparse streams, zero blocks are skipped, but only in empty raw volumes. Other volumes could keep old
+    data in skipped blocks, so whole data is uploaded.
+
+    Sparse upload is done only from the beginning of volume. Libvirt truncates file at each hole, so hole sent at
+    offset would cut off data written further in the file by other uploads (ranges, data chunks).
+    """
+    if sparse and offset > 0:
+        sparse = False
+
+    if sparse:
+        if hasattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM'):
+            bytes = _upload_sparse_stream(conn, volume, chunks, offset, length, progress)
+            if bytes is not None:
+                return bytes
+        if _empty_raw(volume):
+            return _upload_skip_zeros(conn, volume, chunks, offset, progress)
+        log(msg='Volume %s is not empty. Uploading zeros' % volume.name(), tags=('agent', 'image', 'info'))
+
+    stream = conn.newStream(0)
+    volume.upload(stream, offset, length, 0)
+
+    bytes = 0
+    try:
+        for data in chunks:
+            send(stream, data)
+            bytes += len(data)
+            if progress is not None:
+                progress(bytes)
+    except:
+        _abort(stream)
+        raise
+
+    _finish(stream)
+    return bytes
@@ -0,0 +1,268 @@
+"""
+Copyright (C) 2014-2017 cloudover.io ltd.
+This file is part of the CloudOver.org project
+
+Licensee holding a valid commercial license for this software may
+use it in accordance with the terms of the license agreement
+between cloudover.io ltd. and the licensee.
+
+Alternatively you may use this software under following terms of
+GNU Affero GPL v3 license:
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version. For details contact
+with the cloudover.io company: https://cloudover.io/
+
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+
+import Queue
+import datetime
+import threading
+import time
+
+from django.db import connection
+from corecluster.agents.base_agent import BaseAgent
+from corecluster.models.core.agent import Agent
+from corecluster.cache.task import Task
+from corecluster.exceptions.agent import *
+from corenetwork.utils import config
+from corenetwork.utils.logger import log
+
+
+pools_lock = threading.Lock()
+pools = {}
+
+
+class WorkerPool(object):
+    """
+    Threads executing tasks of one kind (long transfers or short control actions) of one agent type. Pool keeps
+    minimum threads and starts new ones up to maximum, when tasks are queued and no thread is idle. New thread is
+    started at once if backlog is as long as number of threads, otherwise when the oldest task waits longer than
+    LIBVIRT_WORKER_SPAWN_DELAY. Threads above minimum exit after LIBVIRT_WORKER_IDLE seconds without task.
+    """
+    def __init__(self, name, minimum, maximum):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum, 1)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = 0
+        self.idle = 0
+        self.idle_timeout = int(config.get('agent', 'LIBVIRT_WORKER_IDLE', 60))
+        self.spawn_delay = float(config.get('agent', 'LIBVIRT_WORKER_SPAWN_DELAY', 2))
+
+        for i in range(self.minimum):
+            self._spawn()
+
+
+    def _spawn(self):
+        self.workers += 1
+        worker = threading.Thread(target=self._work, name='%s-%d' % (self.name, self.workers))
+        worker.daemon = True
+        worker.start()
+
+
+    def _work(self):
+        try:
+            while True:
+                with self.lock:
+                    self.idle += 1
+                try:
+                    queued, function, task = self.queue.get(timeout=self.idle_timeout)
+                except Queue.Empty:
+                    with self.lock:
+                        self.idle -= 1
+                        if self.workers > self.minimum:
+                            self.workers -= 1
+                            return
+                    continue
+
+                with self.lock:
+                    self.idle -= 1
+                function(task)
+        finally:
+            connection.close()
+
+
+    def waiting(self):
+        """
+        How long the oldest queued task waits, in seconds
+        """
+        with self.queue.mutex:
+            if len(self.queue.queue) == 0:
+                return 0
+            return time.time() - self.queue.queue[0][0]
+
+
+    def scale(self):
+        with self.lock:
+            backlog = self.queue.qsize() - self.idle
+            if backlog <= 0 or self.workers >= self.maximum:
+                return
+            if backlog >= self.workers or self.waiting() > self.spawn_delay:
+                log(msg='Starting worker for %s tasks (%d queued)' % (self.name, self.queue.qsize()), tags=('agent', 'workers', 'debug'))
+                self._spawn()
+
+
+    def submit(self, function, task):
+        self.queue.put((time.time(), function, task))
+        self.scale()
+
+
+    def full(self):
+        """
+        Pool has queued at least as many tasks as it could execute at once
+        """
+        return self.queue.qsize() >= self.maximum
+
+
+def get_pool(task_type, kind):
+    """
+    Get pool of given kind (long or short) for agent type. Pools are shared by all agent threads of the type in one
+    process. Sizes are given by LIBVIRT_WORKERS_<KIND>_MIN and LIBVIRT_WORKERS_<KIND>_MAX in agent config.
+    """
+    with pools_lock:
+        if (task_type, kind) not in pools:
+            pools[(task_type, kind)] = WorkerPool('%s-%s' % (task_type, kind),
+                                                  int(config.get('agent', 'LIBVIRT_WORKERS_%s_MIN' % kind.upper(), 1)),
+                                                  int(config.get('agent', 'LIBVIRT_WORKERS_%s_MAX' % kind.upper(), 4)))
+        return pools[(task_type, kind)]
+
+
+class LoopAgent(BaseAgent):
+    """
+    Agent running in loop: tick is called every interval seconds and agent's alive time is updated after each tick,
+    until agent is stopped. Subclasses override prepare, tick and finish instead of run.
+    """
+    def interval(self):
+        return int(config.get('agent', 'TASK_FETCH_INTERVAL', 20))
+
+
+    def prepare(self):
+        """
+        Called once, before agent is set to running state
+        """
+        pass
+
+
+    def tick(self):
+        """
+        Do agent's work. Returns True if next tick should be done at once, without waiting for interval
+        """
+        return False
+
+
+    def finish(self):
+        """
+        Called once, when agent is stopped, before cleanup
+        """
+        pass
+
+
+    def heartbeat(self):
+        self.agent = Agent.objects.get(pk=self.agent.id)
+
+        if self.agent.in_states(['stopping', 'done']):
+            self.i_am_running = False
+
+        self.agent.alive = datetime.datetime.now()
+        self.agent.save()
+
+
+    def run(self):
+        self.init()
+        self.prepare()
+
+        self.agent.set_state('running')
+        self.agent.save()
+
+        log(msg="Agent %s is running" % self.task_type, tags=('agent', self.task_type, 'info'))
+
+        while self.i_am_running:
+            if not self.tick():
+                time.sleep(self.interval())
+            self.heartbeat()
+
+        self.finish()
+
+        self.agent.set_state('done')
+        self.agent.save()
+        self.cleanup()
+
+
+class PooledAgent(LoopAgent):
+    """
+    Agent, which fetches tasks and passes them to worker pools instead of executing them one by one. Actions listed in
+    long_actions (transfers) are executed by separate pool than the rest, so long uploads don't delay short control
+    tasks.
+    """
+    long_actions = []
+
+    def execute(self, task):
+        self.task_started(task)
+        try:
+            action = getattr(self, task.action)
+            action(task)
+            self.task_finished(task)
+        except TaskFatalError as e:
+            self.task_error(task, e)
+        except TaskError as e:
+            self.task_failed(task, e)
+        except TaskNotReady as e:
+            self.task_delayed(task, e)
+        except Exception as e:
+            self.task_error(task, e)
+
+
+    def prepare(self):
+        self.agent.task_fetch_timeout = config.get('agent', 'TASK_FETCH_INTERVAL', 20)
+        self.long_pool = get_pool(self.task_type, 'long')
+        self.short_pool = get_pool(self.task_type, 'short')
+
+
+    def interval(self):
+        return self.agent.get_prop('task_fetch_timeout', config.get('agent', 'TASK_FETCH_INTERVAL', 20))
+
+
+    def tick(self):
+        # Tasks are fetched only for pools which have free queue
+        actions = []
+        if not self.long_pool.full():
+            actions += [action for action in self.supported_actions if action in self.long_actions]
+        if not self.short_pool.full():
+            actions += [action for action in self.supported_actions if action not in self.long_actions]
+
+        tasks = []
+        if len(actions) > 0:
+            try:
+                tasks = Task.get_task(self.task_type, actions, self.agent)
+                for task in tasks:
+                    self.task_assigned(task)
+            except Exception as e:
+                log(msg="Cannot get tasks", exception=e, tags=('agent', self.task_type, 'critical'))
+
+        for task in tasks:
+            if task.action in self.long_actions:
+                self.long_pool.submit(self.execute, task)
+            else:
+                self.short_pool.submit(self.execute, task)
+
+        self.long_pool.scale()
+        self.short_pool.scale()
+
+        # Queue is checked again at once while there are new tasks
+        return len(tasks) > 0
@@ -0,0 +1,47 @@
+import gzip
+import importlib
+import os
+import StringIO
+import unittest
+
+compression = importlib.import_module('corecluster-storage-libvirt.utils.compression')
+
+
+def gzipped(data):
+    f = StringIO.StringIO()
+    g = gzip.GzipFile(fileobj=f, mode='wb')
+    g.write(data)
+    g.close()
+    return f.getvalue()
+
+
+class DecompressReaderTest(unittest.TestCase):
+    def read_all(self, reader, size):
+        parts = []
+        while True:
+            data = reader.read(size)
+            self.assertTrue(len(data) <= size)
+            if len(data) == 0:
+                return ''.join(parts)
+            parts.append(data)
+
+    def test_gzip(self):
+        content = os.urandom(100000) + '\0' * 1000000 + os.urandom(1000)
+        source, kind = compression.open_source(StringIO.StringIO(gzipped(content)))
+        self.assertEqual(kind, 'gzip')
+        self.assertEqual(self.read_all(source, 65536), content)
+
+    def test_output_is_limited(self):
+        # Zeros are compressed about 1000 times, so one input block would expand to 16MB at once
+        reader = compression.DecompressReader(StringIO.StringIO(gzipped('\0' * 64*1024*1024)), 'gzip')
+        self.assertEqual(len(reader.read(4096)), 4096)
+        self.assertEqual(len(reader.read(4096)), 4096)
+
+    def test_not_compressed(self):
+        source, kind = compression.open_source(StringIO.StringIO('plain data'))
+        self.assertEqual(kind, None)
+        self.assertEqual(source.read(100), 'plain data')
+
+
+if __name__ == '__main__':
+    unittest.main()
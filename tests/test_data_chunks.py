@@ -0,0 +1,136 @@
+import base64
+import importlib
+import json
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+data_chunks = importlib.import_module('corecluster-storage-libvirt.utils.data_chunks')
+
+
+class Image(object):
+    id = 'image'
+
+
+class MissingTest(unittest.TestCase):
+    def missing(self, received, size=None):
+        with mock.patch.object(data_chunks, 'received', return_value=received):
+            return data_chunks.missing(Image(), size)
+
+    def test_complete(self):
+        self.assertEqual(self.missing([(0, 10), (10, 5)], 15), [])
+
+    def test_gaps_between_chunks(self):
+        self.assertEqual(self.missing([(0, 10), (20, 5), (30, 5)]), [(10, 10), (25, 5)])
+
+    def test_overlapping_chunks(self):
+        self.assertEqual(self.missing([(0, 10), (5, 10), (15, 5)], 20), [])
+
+    def test_gap_at_end(self):
+        self.assertEqual(self.missing([(0, 10)], 15), [(10, 5)])
+
+    def test_nothing_received(self):
+        self.assertEqual(self.missing([], 15), [(0, 15)])
+        self.assertEqual(self.missing([]), [])
+
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.data = {}
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(field, None)
+
+    def hkeys(self, key):
+        return list(self.data.get(key, {}).keys())
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+cache = None
+
+
+class FakeChunk(object):
+    container = 'data_chunks'
+    chunks = {}
+    loads = 0
+
+    def __init__(self, cache_key=None, data=None):
+        if data is not None:
+            self.id = json.loads(data)['id']
+            self.type = json.loads(data)['type']
+            return
+        FakeChunk.loads += 1
+        self.id = cache_key
+        self.type, self.image_id, self.offset, self.data = FakeChunk.chunks[cache_key]
+
+    def cache_key(self):
+        return self.id
+
+    def delete(self):
+        FakeChunk.chunks.pop(self.id)
+        cache.hdel(self.container, self.id)
+
+
+class ContiguousTest(unittest.TestCase):
+    def setUp(self):
+        global cache
+        self.cache = cache = FakeCache()
+        FakeChunk.chunks = {}
+        FakeChunk.loads = 0
+        patches = [mock.patch.object(data_chunks, 'Cache', self.cache),
+                   mock.patch.object(data_chunks, 'DataChunk', FakeChunk),
+                   mock.patch.object(data_chunks.config, 'get', lambda section, key, default=None: default)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def add(self, key, image_id, offset, length):
+        FakeChunk.chunks[key] = ('DataChunk', image_id, offset, base64.b64encode('x' * length))
+        self.cache.hset(FakeChunk.container, key, '')
+
+    def test_run(self):
+        self.add('a', 'image', 0, 10)
+        self.add('b', 'image', 10, 10)
+        self.add('c', 'image', 30, 10)
+        self.add('d', 'other', 20, 10)
+
+        run = data_chunks.contiguous(Image(), FakeChunk('a'))
+        self.assertEqual([(key, offset, length) for key, chunk, offset, length in run], [('a', 0, 10), ('b', 10, 10)])
+
+    def test_chunks_loaded_once(self):
+        self.add('a', 'image', 0, 10)
+        self.add('b', 'image', 10, 10)
+        self.add('c', 'other', 0, 10)
+
+        data_chunks.contiguous(Image(), FakeChunk('a'))
+        loads = FakeChunk.loads
+        data_chunks.contiguous(Image(), FakeChunk('a'))
+        self.assertEqual(FakeChunk.loads, loads + 1)
+
+    def test_deleted_chunk(self):
+        self.add('a', 'image', 0, 10)
+        self.add('b', 'image', 10, 10)
+
+        run = data_chunks.contiguous(Image(), FakeChunk('a'))
+        data_chunks.delete('b', run[1][1])
+        self.assertEqual(self.cache.hkeys(FakeChunk.container), ['a'])
+
+        run = data_chunks.contiguous(Image(), FakeChunk('a'))
+        self.assertEqual(len(run), 1)
+        self.assertEqual(self.cache.hkeys(data_chunks.INDEX_KEY), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import BaseHTTPServer
+import SocketServer
+import gzip
+import importlib
+import os
+import StringIO
+import threading
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+ranged_download = importlib.import_module('corecluster-storage-libvirt.utils.ranged_download')
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.data = {}
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hkeys(self, key):
+        return list(self.data.get(key, {}).keys())
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    content = ''
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_headers(self, code, length):
+        self.send_response(code)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.send_headers(200, len(self.content))
+
+    def do_GET(self):
+        header = self.headers.getheader('Range')
+        RangeHandler.requests.append(header)
+        if header is None:
+            self.send_headers(200, len(self.content))
+            self.wfile.write(self.content)
+            return
+
+        start, end = header.split('=')[1].split('-')
+        data = self.content[int(start):int(end) + 1]
+        self.send_headers(206, len(data))
+        self.wfile.write(data)
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RangedDownloadTest(unittest.TestCase):
+    settings = {
+        'LIBVIRT_RANGE_SIZE': 1000,
+        'LIBVIRT_RANGE_CONNECTIONS': 3,
+        'LIBVIRT_RANGE_RETRIES': 1,
+        'LIBVIRT_TRANSFER_CHUNK_SIZE': 300,
+    }
+
+    def setUp(self):
+        RangeHandler.content = os.urandom(10500)
+        RangeHandler.requests = []
+        self.server = ThreadedServer(('127.0.0.1', 0), RangeHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/image' % self.server.server_address[1]
+
+        config = mock.Mock()
+        config.get.side_effect = lambda section, key, default=None: self.settings.get(key, default)
+        self.cache = FakeCache()
+        self.patches = [mock.patch.object(ranged_download, 'config', config),
+                        mock.patch.object(ranged_download.transfer, 'config', config),
+                        mock.patch.object(ranged_download, 'Cache', self.cache),
+                        mock.patch.object(ranged_download, 'connection', mock.Mock())]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def download(self, download):
+        buf = bytearray(len(RangeHandler.content))
+        lock = threading.Lock()
+
+        def write(offset, length, chunks, progress):
+            data = ''.join(chunks)
+            self.assertEqual(len(data), length)
+            with lock:
+                buf[offset:offset + length] = data
+            progress(length)
+
+        bytes = download.run(write)
+        return bytes, str(buf)
+
+    def test_supported(self):
+        self.assertTrue(ranged_download.supported(self.url, len(RangeHandler.content)))
+        self.assertFalse(ranged_download.supported(self.url, len(RangeHandler.content) + 1))
+
+    def test_compressed_content_is_not_supported(self):
+        compressed = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=compressed, mode='wb')
+        f.write(RangeHandler.content)
+        f.close()
+        RangeHandler.content = compressed.getvalue()
+        self.assertFalse(ranged_download.supported(self.url, len(RangeHandler.content)))
+
+    def test_download(self):
+        download = ranged_download.RangedDownload(self.url, len(RangeHandler.content), 'ranges')
+        bytes, data = self.download(download)
+        self.assertEqual(bytes, len(RangeHandler.content))
+        self.assertEqual(data, RangeHandler.content)
+        self.assertEqual(len(RangeHandler.requests), 11)
+        self.assertEqual(self.cache.hkeys('ranges'), [])
+
+    def test_resume(self):
+        download = ranged_download.RangedDownload(self.url, len(RangeHandler.content), 'ranges')
+        download.pending()
+        self.cache.hset('ranges', '0', '1')
+        self.cache.hset('ranges', '5', '1')
+
+        bytes, data = self.download(download)
+        self.assertEqual(bytes, len(RangeHandler.content))
+        self.assertEqual(len(RangeHandler.requests), 9)
+        self.assertNotIn('bytes=0-999', RangeHandler.requests)
+        self.assertEqual(data[1000:5000], RangeHandler.content[1000:5000])
+
+
+if __name__ == '__main__':
+    unittest.main()
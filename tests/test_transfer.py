@@ -0,0 +1,30 @@
+import importlib
+import unittest
+
+transfer = importlib.import_module('corecluster-storage-libvirt.utils.transfer')
+
+
+class RegionsTest(unittest.TestCase):
+    def regions(self, chunks, block=2):
+        return list(transfer.regions(chunks, block))
+
+    def test_data_only(self):
+        self.assertEqual(self.regions(['abcd', 'ef']), [('abcd', 4), ('ef', 2)])
+
+    def test_zero_regions_are_merged_between_chunks(self):
+        self.assertEqual(self.regions(['ab\0\0\0\0', '\0\0\0\0cd']),
+                         [('ab', 2), (None, 8), ('cd', 2)])
+
+    def test_trailing_hole(self):
+        self.assertEqual(self.regions(['\0\0\0\0']), [(None, 4)])
+
+    def test_partial_block(self):
+        self.assertEqual(self.regions(['a\0\0']), [('a\0', 2), (None, 1)])
+
+    def test_lengths_sum_to_input(self):
+        chunks = ['\0' * 5 + 'x' + '\0' * 7, 'yz' + '\0' * 3]
+        self.assertEqual(sum([length for data, length in self.regions(chunks, 4)]), sum(map(len, chunks)))
+
+
+if __name__ == '__main__':
+    unittest.main()